@@ -6,7 +6,16 @@ import argparse
 import itertools
 import collections
 import json
-import itertools
+import time
+import datetime
+import io
+import hashlib
+import tokenize
+import os
+import math
+import functools
+import bisect
+import glob
 
 def get_file(value):
     return open(value, 'rb')
@@ -22,34 +31,141 @@ def check_line_limit(value):
         raise argparse.ArgumentTypeError("%s is an invalid line limit" % value)
     return ivalue
 
+def check_positive_int(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError("%s must be a positive integer" % value)
+    return ivalue
+
+def check_seconds(value):
+    fvalue = float(value)
+    if fvalue < 0:
+        raise argparse.ArgumentTypeError("%s is an invalid number of seconds" % value)
+    return fvalue
+
 def check_percentage_limit(value):
     ivalue = float(value)
     if ivalue < 0:
         raise argparse.ArgumentTypeError("%s is an invalid percentage limit" % value)
     return ivalue
 
+def check_shard(value):
+    try:
+        shard, shard_count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a shard I/N" % value)
+    if not 0 <= shard < shard_count:
+        raise argparse.ArgumentTypeError("%s is not a shard I/N with 0 <= I < N" % value)
+    return shard, shard_count
+
+def check_similarity(value):
+    fvalue = float(value)
+    if not 0 < fvalue <= 1:
+        raise argparse.ArgumentTypeError("%s is not a similarity in (0, 1]" % value)
+    return fvalue
 
 
 # taken from: https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
-def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█'):
+def printProgressBar (iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', file = None):
     
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
     bar = fill * filledLength + '-' * (length - filledLength)
-    print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end = '\r')
+    print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end = '\r', file = file)
     
     # Print New Line on Complete
     if iteration == total: 
-        print()
+        print(file = file)
+
+class ProgressReporter(object):
+    """
+    Time throttled progress reporting with throughput and ETA.
+
+    The bar is redrawn at most once per interval and only when the stream is a
+    TTY. Optionally, progress events are appended as JSON lines to an event
+    stream for machine consumption.
+
+    The clock is read on every advance: that costs far less than scoring the
+    pair, and a stride learned on fast pairs would stall the updates once the
+    pairs get slow.
+    """
+
+    def __init__(self, total, interval=0.2, stream=None, event_stream=None, clock=time.time):
+        self.total = total
+        self.done = 0
+        self._interval = interval
+        self._stream = stream if stream is not None else sys.stdout
+        self._show_bar = bool(getattr(self._stream, 'isatty', lambda: False)())
+        self._event_stream = event_stream
+        self._clock = clock
+        self._start = clock()
+        self._next_report = self._start
+        self._drawn = None
+
+    @property
+    def enabled(self):
+        return self._show_bar or self._event_stream is not None
+
+    def start(self):
+        self._report('start', self._clock())
+
+    def advance(self, count=1):
+        self.done += count
+        if not self.enabled:
+            return
+        now = self._clock()
+        if now >= self._next_report:
+            self._report('progress', now)
+
+    def finish(self):
+        self._report('done', self._clock())
+
+    def _rate(self, now):
+        elapsed = now - self._start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def _report(self, event, now):
+        self._next_report = now + self._interval
+        rate = self._rate(now)
+        eta = (self.total - self.done) / rate if rate > 0 else None
+        if self._show_bar and self.total > 0 and self._drawn != self.done:
+            self._drawn = self.done
+            suffix = '{:.1f} pairs/s ETA {}'.format(
+                rate, datetime.timedelta(seconds=int(eta)) if eta is not None else '?')
+            printProgressBar(self.done, self.total, prefix = 'Progress:', suffix = suffix, length = 50,
+                             file = self._stream)
+        if self._event_stream is not None:
+            self._event_stream.write(json.dumps({
+                "event": event,
+                "done": self.done,
+                "total": self.total,
+                "elapsed": round(now - self._start, 3),
+                "rate": round(rate, 3),
+                "eta": round(eta, 3) if eta is not None else None
+            }) + "\n")
+            self._event_stream.flush()
+
+FUNCTION_NODE_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+def is_str_node(node):
+    """
+    True for string literals: ast.Constant on python 3.8+, ast.Str before.
+    """
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, str)
+    return type(node).__name__ == 'Str'
 
 class FuncNodeCollector(ast.NodeTransformer):
     """
     Clean node attributes, delete the attributes that are not helpful for recognition repetition.
     Then collect all function nodes.
+
+    This mutates the tree and is kept as the reference implementation, FuncNormalizer is used by default.
     """
 
-    def __init__(self):
+    def __init__(self, with_tree=False):
         super(FuncNodeCollector, self).__init__()
+        self._with_tree = with_tree
         self._curr_class_names = []
         self._func_nodes = []
         self._last_node_lineno = -1
@@ -86,9 +202,9 @@ class FuncNodeCollector(ast.NodeTransformer):
         """
 
         def _mark_docstring_nodes(body):
-            if body and isinstance(body, collections.Sequence):
+            if body and isinstance(body, list):
                 for n in body:
-                    if isinstance(n, ast.Expr) and isinstance(n.value, ast.Str):
+                    if isinstance(n, ast.Expr) and is_str_node(n.value):
                         n.is_docstring = True
 
         node_body = getattr(node, 'body', None)
@@ -107,10 +223,18 @@ class FuncNodeCollector(ast.NodeTransformer):
         return super(FuncNodeCollector, self).generic_visit(node)
 
     def visit_Str(self, node):
+        # python < 3.8
         del node.s
         self.generic_visit(node)
         return node
 
+    def visit_Constant(self, node):
+        # python >= 3.8, only string constants are stripped like ast.Str
+        if isinstance(node.value, str):
+            del node.value
+        self.generic_visit(node)
+        return node
+
     def visit_Expr(self, node):
         if not self._is_docstring(node):
             self.generic_visit(node)
@@ -140,6 +264,21 @@ class FuncNodeCollector(ast.NodeTransformer):
         self.generic_visit(node)
         return node
 
+    def visit_MatchAs(self, node):
+        del node.name  # the capture names of match patterns, python 3.10+
+        self.generic_visit(node)
+        return node
+
+    def visit_MatchStar(self, node):
+        del node.name
+        self.generic_visit(node)
+        return node
+
+    def visit_MatchMapping(self, node):
+        del node.rest
+        self.generic_visit(node)
+        return node
+
     def visit_Call(self, node):
         func = getattr(node, 'func', None)
         if func and isinstance(func, ast.Name) and func.id == 'print':
@@ -157,10 +296,12 @@ class FuncNodeCollector(ast.NodeTransformer):
         self._func_nodes.append(node)
         count = self._node_count
         self.generic_visit(node)
-        node.endlineno = self._last_node_lineno
+        node.endlineno = max(self._last_node_lineno, getattr(node, 'end_lineno', None) or -1)
         node.nsubnodes = self._node_count - count
         return node
 
+    visit_AsyncFunctionDef = visit_FunctionDef
+
     def visit_Compare(self, node):
 
         def _simple_nomalize(*ops_type_names):
@@ -196,6 +337,485 @@ class FuncNodeCollector(ast.NodeTransformer):
     def get_function_nodes(self):
         return self._func_nodes
 
+    def get_function_infos(self, source):
+        return FuncInfo.from_nodes(self._func_nodes, source, self._with_tree)
+
+
+_AST = ast.AST
+_MISSING = object()
+
+def _join_dump(prefix, suffix, children, depth, indentation='    ', maxline=120, maxmerged=80):
+    """
+    Lay out one node of a dump exactly like FuncInfo._dump does at the given depth.
+    """
+    oneline = '%s%s%s' % (prefix, ', '.join(children), suffix)
+    if len(oneline) + len(indentation) * depth < maxline:
+        return oneline
+    level = indentation * (depth + 1)
+    if children and len(prefix) + len(children[0]) < maxmerged:
+        prefix = '%s%s,' % (prefix, children[0])
+        children = children[1:]
+    return '%s\n%s%s%s' % (prefix, level, (',\n%s' % level).join(children).lstrip(), suffix)
+
+
+# Handler results of normalization rules besides a view, see NormalizationProfile.
+REMOVE = 'remove'  # drop the node and its sub nodes
+RAW = 'raw'  # keep the node and its sub nodes as they are
+
+def _make_constant(value, like):
+    if sys.version_info >= (3, 8):
+        node = ast.Constant(value=value, kind=None)
+    else:
+        node = ast.Num(n=value)
+    return ast.copy_location(node, like)
+
+def _constant_number(node):
+    if isinstance(node, ast.Constant):
+        value = node.value
+    elif type(node).__name__ == 'Num':
+        value = node.n
+    else:
+        return _MISSING
+    if isinstance(value, (int, float, complex)) and not isinstance(value, bool):
+        return value
+    return _MISSING
+
+_FOLDED_BINOPS = {
+    'Add': operator.add, 'Sub': operator.sub, 'Mult': operator.mul, 'Div': operator.truediv,
+    'FloorDiv': operator.floordiv, 'Mod': operator.mod, 'Pow': operator.pow,
+    'LShift': operator.lshift, 'RShift': operator.rshift,
+    'BitOr': operator.or_, 'BitXor': operator.xor, 'BitAnd': operator.and_,
+}
+_FOLDED_UNARYOPS = {'UAdd': operator.pos, 'USub': operator.neg, 'Invert': operator.invert}
+
+def _fold_number(node):
+    """
+    Evaluate an arithmetic expression of number literals, _MISSING if it is not one.
+    """
+    type_name = type(node).__name__
+    if type_name == 'UnaryOp':
+        operand = _fold_number(node.operand)
+        op = _FOLDED_UNARYOPS.get(type(node.op).__name__)
+        if operand is _MISSING or op is None:
+            return _MISSING
+        return op(operand)
+    if type_name == 'BinOp':
+        op_name = type(node.op).__name__
+        op = _FOLDED_BINOPS.get(op_name)
+        left = _fold_number(node.left)
+        right = _fold_number(node.right) if left is not _MISSING else _MISSING
+        if op is None or right is _MISSING:
+            return _MISSING
+        if op_name in ('Pow', 'LShift') and (not isinstance(right, (int, float)) or abs(right) > 64):
+            return _MISSING  # keep huge results out of the dump
+        value = op(left, right)
+        if isinstance(value, int) and value.bit_length() > 256:
+            return _MISSING
+        return value
+    return _constant_number(node)
+
+def _rule_fold_constants(node, field, view):
+    try:
+        value = _fold_number(node)
+    except (ArithmeticError, TypeError, ValueError, RecursionError):
+        return view
+    if value is _MISSING:
+        return view
+    folded = _make_constant(value, node)
+    return type(folded).__name__, view[1], None, folded
+
+_SWAPPED_OPS = {'Eq': None, 'Gt': ast.Lt, 'Lt': ast.Gt, 'GtE': ast.LtE, 'LtE': ast.GtE}
+
+def _rule_compare(node, field, view):
+    # Same as FuncNodeCollector.visit_Compare
+    ops, left, comparators = node.ops, node.left, node.comparators
+    if len(ops) == 1 and len(comparators) == 1:
+        op_name = type(ops[0]).__name__
+        right = comparators[0]
+        if op_name in _SWAPPED_OPS and type(left).__name__ > type(right).__name__:
+            swapped_op = _SWAPPED_OPS[op_name]
+            overrides = {'left': right, 'comparators': [left],
+                         'ops': [swapped_op()] if swapped_op is not None else ops}
+            return view[0], view[1], overrides, view[3]
+    return view
+
+_COMMUTATIVE_OPS = ('Add', 'Mult', 'BitOr', 'BitXor', 'BitAnd')
+
+def _rule_commutative_binop(node, field, view):
+    if type(node.op).__name__ in _COMMUTATIVE_OPS and type(node.left).__name__ > type(node.right).__name__:
+        return view[0], view[1], {'left': node.right, 'right': node.left}, view[3]
+    return view
+
+def _rule_commutative_boolop(node, field, view):
+    values = sorted(node.values, key=lambda value: type(value).__name__)
+    return view[0], view[1], {'values': values}, view[3]
+
+def _rule_strip_str_constant(node, field, view):
+    if isinstance(node.value, str):
+        return view[0], view[1] + ('value',), view[2], view[3]
+    return view
+
+def _rule_docstring(node, field, view):
+    # Same as FuncNodeCollector._mark_docstring_sub_nodes
+    if (field == 'body' or field == 'orelse') and is_str_node(node.value):
+        return REMOVE
+    return view
+
+def _rule_print_call(node, field, view):
+    func = node.func
+    if type(func) is ast.Name and func.id == 'print':
+        return REMOVE  # remove print call and its sub nodes for python3
+    return view
+
+def _rule_raw(node, field, view):
+    return RAW
+
+def _rule_remove(node, field, view):
+    return REMOVE
+
+# Every rule maps node type names to the fields it drops (a tuple) or to a
+# handler(node, parent field, view) returning a new view, REMOVE or RAW.
+# Rules are applied in this order.
+NORMALIZATION_RULES = collections.OrderedDict([
+    ('functions', {'FunctionDef': ('name',), 'AsyncFunctionDef': ('name',)}),
+    ('imports', {'Import': _rule_remove, 'ImportFrom': _rule_remove}),
+    ('docstrings', {'Expr': _rule_docstring}),
+    ('print', {'Call': _rule_print_call, 'Print': _rule_remove}),
+    ('raw_calls', {'Call': _rule_raw}),
+    ('names', {'Name': ('id', 'ctx'), 'Attribute': ('attr', 'ctx'), 'arg': ('arg', 'annotation'),
+               'MatchAs': ('name',), 'MatchStar': ('name',), 'MatchMapping': ('rest',)}),
+    ('strings', {'Str': ('s',), 'Constant': _rule_strip_str_constant}),
+    ('fold_constants', {'BinOp': _rule_fold_constants, 'UnaryOp': _rule_fold_constants}),
+    ('compare', {'Compare': _rule_compare}),
+    ('commutative', {'BinOp': _rule_commutative_binop, 'BoolOp': _rule_commutative_boolop}),
+    ('loops', {'For': ('target', 'iter', 'type_comment'), 'AsyncFor': ('target', 'iter', 'type_comment'),
+               'While': ('test',)}),
+])
+
+# Node types renamed by a rule, so that different forms share one label.
+_RULE_LABELS = {
+    'loops': {'For': 'Loop', 'AsyncFor': 'Loop', 'While': 'Loop'},
+}
+
+PROFILES = {
+    # the normalizations of FuncNodeCollector
+    'default': ('functions', 'docstrings', 'print', 'raw_calls', 'names', 'strings', 'compare'),
+    # also normalizes inside calls, for obfuscated code
+    'strict': ('functions', 'imports', 'docstrings', 'print', 'names', 'strings', 'fold_constants',
+               'compare', 'commutative', 'loops'),
+}
+
+class NormalizationProfile(object):
+    """
+    A set of normalization rules, compiled once into a flat dispatch table.
+
+    The table maps a node type name to a single handler(node, parent field)
+    returning REMOVE, RAW or a view (label, dropped fields, field overrides,
+    replacement node), so FuncNormalizer does one dict lookup per node no
+    matter how many rules are enabled.
+    """
+
+    _compiled = {}
+
+    def __init__(self, name, rules):
+        unknown = set(rules) - set(NORMALIZATION_RULES)
+        if unknown:
+            raise ValueError('Unknown normalization rules: {}'.format(', '.join(sorted(unknown))))
+        self.name = name
+        self.rules = tuple(rule for rule in NORMALIZATION_RULES if rule in rules)
+        self.profile_id = '{}-{}'.format(name, hashlib.sha1(','.join(self.rules).encode('utf-8')).hexdigest()[:8])
+        self.dispatch = self._compile()
+
+    @classmethod
+    def get(cls, name):
+        """
+        The compiled profile of the given name, compiled once per process.
+        """
+        profile = cls._compiled.get(name)
+        if profile is None:
+            profile = cls._compiled[name] = cls(name, PROFILES[name])
+        return profile
+
+    def _compile(self):
+        type_names = []
+        for rule in self.rules:
+            type_names.extend(name for name in NORMALIZATION_RULES[rule] if name not in type_names)
+        dispatch = {}
+        for type_name in type_names:
+            label = type_name
+            dropped = ()
+            handlers = []
+            for rule in self.rules:
+                part = NORMALIZATION_RULES[rule].get(type_name)
+                if part is None:
+                    continue
+                label = _RULE_LABELS.get(rule, {}).get(type_name, label)
+                if isinstance(part, tuple):
+                    dropped += part
+                else:
+                    handlers.append(part)
+            dispatch[type_name] = self._compose((label, dropped, None, None), tuple(handlers))
+        return dispatch
+
+    @staticmethod
+    def _compose(base_view, handlers):
+        if not handlers:
+            return lambda node, field: base_view
+        if len(handlers) == 1:
+            handler = handlers[0]
+            return lambda node, field: handler(node, field, base_view)
+
+        def _handle(node, field):
+            view = base_view
+            for handler in handlers:
+                view = handler(node, field, view)
+                if view is REMOVE or view is RAW or view[3] is not None:
+                    break  # a replaced node is not handled by the rules of the original type
+            return view
+        return _handle
+
+class _NormalizerFrame(object):
+    """
+    A node on the FuncNormalizer stack, waiting for the results of its children.
+
+    depth is the nesting depth of the node in the dump of the whole file and
+    roots holds the depths of the enclosing functions, the node is laid out at
+    depth - root in the dump of each of them.
+    """
+
+    __slots__ = ('node', 'view', 'prefix', 'depth', 'roots', 'parent', 'slot', 'raw', 'classes',
+                 'entered', 'type_name', 'fields', 'results', 'func_index', 'count')
+
+    def __init__(self, node, view, prefix, depth, roots, parent, slot, raw, classes):
+        self.node = node
+        self.view = view
+        self.prefix = prefix
+        self.depth = depth
+        self.roots = roots
+        self.parent = parent
+        self.slot = slot
+        self.raw = raw
+        self.classes = classes
+        self.entered = False
+        self.func_index = None
+
+
+class FuncNormalizer(object):
+    """
+    Single pass replacement of FuncNodeCollector and FuncInfo._dump.
+
+    The tree is walked once, iteratively and without being mutated. The
+    normalizations of the profile are applied on the fly (the default profile
+    is the same as FuncNodeCollector) and every function's dump lines
+    (formatted exactly like FuncInfo._dump formats the mutated tree), node
+    count and line span are emitted during the walk. Every node is laid out
+    once per enclosing function, at its depth relative to that function, so
+    nested functions are not walked a second time.
+    """
+
+    def __init__(self, with_tree=False, profile=None):
+        self._curr_class_names = []
+        self._funcs = []
+        self._last_node_lineno = -1
+        self._node_count = 0
+        self._with_tree = with_tree
+        self._dispatch = (profile or NormalizationProfile.get('default')).dispatch
+
+    def visit(self, root_node):
+        stack = [_NormalizerFrame(root_node, None, '', 0, (), None, 0, False, tuple(self._curr_class_names))]
+        enter = self._enter
+        leave = self._leave
+        while stack:
+            frame = stack.pop()
+            if frame.entered:
+                leave(frame)
+            else:
+                enter(frame, stack)
+        return root_node
+
+    def _child(self, node, field, prefix, depth, roots, parent, raw, classes, children):
+        """
+        Register a child node in its parent, return its slot in parent.results.
+
+        Removed nodes get no slot, operators and contexts are done right away
+        and all others are queued in children.
+        """
+        view = None
+        if not raw:
+            handler = self._dispatch.get(type(node).__name__)
+            if handler is not None:
+                view = handler(node, field)
+                if view is REMOVE:
+                    return None
+                if view is RAW:
+                    view = None
+                    raw = True
+        if raw and not roots:
+            return None  # nothing outside of a function is dumped
+        results = parent.results
+        slot = len(results)
+        if node._fields or node._attributes:  # statements without fields carry a lineno, keep them in order
+            children.append(_NormalizerFrame(node, view, prefix, depth, roots, parent, slot, raw, classes))
+            results.append(None)
+        else:
+            results.append(self._leaf(node, view[0] if view else type(node).__name__, prefix, depth, roots, raw))
+        return slot
+
+    def _enter(self, frame, stack):
+        """
+        Collect the (normalized) fields of a node and push its children.
+        """
+        frame.entered = True
+        stack.append(frame)
+        node = frame.node
+        view = frame.view
+        if view is None:
+            type_name = type(node).__name__
+            dropped = ()
+            overrides = None
+        else:
+            type_name, dropped, overrides, replacement = view
+            if replacement is not None:
+                node = replacement
+        frame.type_name = type_name
+        fields = frame.fields = []
+        frame.results = []
+        depth = frame.depth
+        roots = frame.roots
+        raw = frame.raw
+        classes = frame.classes
+        if not raw:
+            self._node_count += 1
+            lineno = getattr(node, 'lineno', -1)
+            if lineno > self._last_node_lineno:
+                self._last_node_lineno = lineno
+            if type_name == 'FunctionDef' or type_name == 'AsyncFunctionDef':
+                frame.func_index = len(self._funcs)
+                frame.count = self._node_count - 1
+                self._funcs.append(['.'.join(classes + (node.name,)), node])
+                roots = roots + (depth,)
+            elif type_name == 'ClassDef':
+                classes = classes + (node.name,)
+
+        children = []
+        child = self._child
+        node_type = type(node)
+        for name in node._fields:
+            if name in dropped:
+                # deleting an optional field uncovers its class level default (python >= 3.8),
+                # a relabelled node does not have one
+                value = getattr(node_type, name, _MISSING) if type_name == node_type.__name__ else _MISSING
+                if value is not _MISSING:
+                    fields.append((name, 'val', value))
+                continue
+            if overrides is not None and name in overrides:
+                value = overrides[name]
+            else:
+                value = getattr(node, name, _MISSING)
+            if isinstance(value, _AST):
+                slot = child(value, name, name + '=', depth + 1, roots, frame, raw, classes, children)
+                if slot is not None:
+                    fields.append((name, 'ast', slot))
+            elif type(value) is list:
+                items = []
+                item_depth = depth + 2
+                for list_item in value:
+                    if not isinstance(list_item, _AST):
+                        items.append((False, list_item))
+                        continue
+                    slot = child(list_item, name, '', item_depth, roots, frame, raw, classes, children)
+                    if slot is not None:
+                        items.append((True, slot))
+                fields.append((name, 'list', items))
+            elif value is not _MISSING:
+                fields.append((name, 'val', value))
+        children.reverse()
+        stack.extend(children)
+
+    def _leaf(self, node, type_name, prefix, depth, roots, raw):
+        """
+        Result of an operator or context node, done without a frame.
+        """
+        if not raw:
+            self._node_count += 1
+        renders = [_join_dump(prefix + type_name, '', [], depth - root) for root in roots]
+        return renders, (type_name, ()) if self._with_tree and roots else None
+
+    def _leave(self, frame):
+        """
+        Lay out a node once all of its children are done and hand it to its parent.
+        """
+        results = frame.results
+        fields = frame.fields
+        type_name = frame.type_name
+        if type_name == 'Expr' and not frame.raw and \
+                not any(name == 'value' and results[slot] is not None for name, kind, slot in fields):
+            result = None  # the expression was a removed print call
+        elif not frame.roots and frame.func_index is None:
+            result = _MISSING  # outside of any function, only presence matters
+        else:
+            renders = [self._render(type_name, frame.prefix, fields, results, k, frame.depth - root)
+                       for k, root in enumerate(frame.roots)]
+            tree = None
+            if self._with_tree:
+                tree = (type_name, tuple(self._iter_child_trees(fields, results)))
+            result = (renders, tree)
+
+            if frame.func_index is not None:
+                record = self._funcs[frame.func_index]
+                node = record[1]
+                # the function's own dump, laid out at depth 0 without a field name
+                own_render = self._render(type_name, '', fields, results, len(frame.roots), 0)
+                record[1:] = [node.lineno, node.col_offset,
+                              max(self._last_node_lineno, getattr(node, 'end_lineno', None) or -1),
+                              self._node_count - frame.count, own_render, tree]
+
+        if frame.parent is not None:
+            frame.parent.results[frame.slot] = result
+
+    @staticmethod
+    def _iter_child_trees(fields, results):
+        for name, kind, value in fields:
+            if kind == 'ast':
+                if results[value] is not None:
+                    yield results[value][1]
+            elif kind == 'list':
+                for is_node, item in value:
+                    if is_node and results[item] is not None:
+                        yield results[item][1]
+
+    @staticmethod
+    def _render(type_name, prefix, fields, results, k, depth):
+        children = []
+        has_values = False
+        for name, kind, value in fields:
+            if kind == 'ast':
+                result = results[value]
+                if result is None:
+                    continue  # removed, FuncNodeCollector deletes the attribute
+                has_values = True
+                if name != 'ctx':
+                    children.append(result[0][k])
+            elif kind == 'list':
+                has_values = True
+                items = [results[item][0][k] if is_node else repr(item)
+                         for is_node, item in value if not is_node or results[item] is not None]
+                children.append(_join_dump(name + '=[', ']', items, depth + 1))
+            else:
+                has_values = True
+                children.append('%s=%s' % (name, repr(value)))
+        if not has_values:
+            return _join_dump(prefix + type_name, '', [], depth)
+        return _join_dump('%s%s(' % (prefix, type_name), ')', children, depth)
+
+    def get_function_infos(self, source):
+        """
+        :param source: file name or code lines, see FuncInfo
+        """
+        return [FuncInfo(name, lineno, col_offset, endlineno, nsubnodes, dump.splitlines(True), source,
+                         func_tree=tree)
+                for name, lineno, col_offset, endlineno, nsubnodes, dump, tree in self._funcs]
+
 
 class FuncInfo(object):
     """
@@ -211,15 +831,48 @@ class FuncInfo(object):
     class NonExistent(object):
         pass
 
-    def __init__(self, func_node, code_lines):
-        assert isinstance(func_node, ast.FunctionDef)
-        self._func_node = func_node
-        self._code_lines = code_lines
-        self._func_name = func_node.__dict__.pop('name', '')
-        self._func_code = None
-        self._func_code_lines = None
-        self._func_ast = None
-        self._func_ast_lines = None
+    # Only what scoring needs is kept: no AST nodes and no source text. The
+    # dump lines are interned, they repeat a lot across functions and files.
+    __slots__ = ('_func_name', 'lineno', 'col_offset', 'endlineno', 'nsubnodes', '_func_ast_lines', '_source',
+                 '_struct_hash', '_func_tree', '_line_counts')
+
+    def __init__(self, func_name, lineno, col_offset, endlineno, nsubnodes, func_ast_lines, source,
+                 struct_hash=None, func_tree=None):
+        """
+        :param source: the file name to reload the code from on demand, or
+                       the code lines themselves if they are not in a file
+        """
+        self._func_name = func_name
+        self.lineno = lineno
+        self.col_offset = col_offset
+        self.endlineno = endlineno
+        self.nsubnodes = nsubnodes
+        self._source = source
+        self._struct_hash = struct_hash
+        self._func_tree = func_tree
+        self._func_ast_lines = tuple(sys.intern(line) for line in func_ast_lines)
+        self._line_counts = None
+
+    def __setstate__(self, state):
+        for name, value in state[1].items():
+            setattr(self, name, value)
+        # unpickled strings are not interned, and string hashes differ between processes
+        self._func_ast_lines = tuple(sys.intern(line) for line in self._func_ast_lines)
+        self._line_counts = None
+
+    @classmethod
+    def from_nodes(cls, func_nodes, code_lines, with_tree=False):
+        """
+        Build FuncInfo from the function nodes of a tree mutated by FuncNodeCollector.
+
+        The names are popped from every node before any of them is dumped, so
+        nested functions are dumped without their names inside their parent too.
+        """
+        names = [func_node.__dict__.pop('name', '') for func_node in func_nodes]
+        return [cls(name, func_node.lineno, func_node.col_offset, func_node.endlineno, func_node.nsubnodes,
+                    cls._dump(func_node).splitlines(True), code_lines,
+                    func_tree=cls._node_tree(func_node) if with_tree else None)
+                for name, func_node in zip(names, func_nodes)]
 
     def __str__(self):
         return '<' + type(self).__name__ + ': ' + self.func_name + '>'
@@ -229,42 +882,61 @@ class FuncInfo(object):
         return self._func_name
 
     @property
-    def func_node(self):
-        return self._func_node
+    def func_tree(self):
+        """
+        The normalized tree as nested (label, children) tuples, see TreeDiff.
+        """
+        assert self._func_tree is not None, 'parsed without with_tree'
+        return self._func_tree
+
+    @property
+    def has_tree(self):
+        return self._func_tree is not None
+
+    @property
+    def struct_hash(self):
+        if self._struct_hash is None:
+            digest = hashlib.sha1()
+            for line in self._func_ast_lines:
+                digest.update(line.encode('utf-8'))
+            self._struct_hash = digest.hexdigest()
+        return self._struct_hash
+
+    @property
+    def line_counts(self):
+        """
+        The AST lines as a multiset: sorted (line hash, count) pairs, computed on first use.
+        """
+        if self._line_counts is None:
+            self._line_counts = tuple(sorted(collections.Counter(hash(line) for line in self._func_ast_lines).items()))
+        return self._line_counts
 
     @property
     def func_code(self):
-        if self._func_code is None:
-            self._func_code = ''.join(self.func_code_lines)
-        return self._func_code
+        return ''.join(self.func_code_lines)
 
     @property
     def func_code_lines(self):
-        if self._func_code_lines is None:
-            self._func_code_lines = self._retrieve_func_code_lines(self._func_node, self._code_lines)
-        return self._func_code_lines
+        code_lines = self._source
+        if not isinstance(code_lines, (list, tuple)):
+            code_lines = source_lines(code_lines)
+        return self._retrieve_func_code_lines(self.lineno, self.endlineno, code_lines)
 
     @property
     def func_ast(self):
-        if self._func_ast is None:
-            self._func_ast = self._dump(self._func_node)
-        return self._func_ast
+        return ''.join(self._func_ast_lines)
 
     @property
     def func_ast_lines(self):
-        if self._func_ast_lines is None:
-            self._func_ast_lines = self.func_ast.splitlines(True)
         return self._func_ast_lines
 
     @staticmethod
-    def _retrieve_func_code_lines(func_node, code_lines):
-        if not isinstance(func_node, ast.FunctionDef):
+    def _retrieve_func_code_lines(lineno, endlineno, code_lines):
+        if not isinstance(code_lines, (list, tuple)):
             return []
-        if not isinstance(code_lines, collections.Sequence) or isinstance(code_lines, basestring):
+        if endlineno < lineno:
             return []
-        if getattr(func_node, 'endlineno', -1) < getattr(func_node, 'lineno', 0):
-            return []
-        lines = code_lines[func_node.lineno - 1: func_node.endlineno]
+        lines = code_lines[lineno - 1: endlineno]
         if lines:
             padding = lines[0][:-len(lines[0].lstrip())]
             stripped_lines = []
@@ -278,6 +950,10 @@ class FuncInfo(object):
                 return stripped_lines
         return lines
 
+    @staticmethod
+    def _node_tree(node):
+        return type(node).__name__, tuple(FuncInfo._node_tree(n) for n in ast.iter_child_nodes(node))
+
     @staticmethod
     def _iter_node(node, name='', missing=NonExistent):
         """Iterates over an object:
@@ -366,12 +1042,12 @@ class FuncDiffInfo(object):
         if isinstance(self.info_ref, FuncInfo) and isinstance(self.info_candidate, FuncInfo):
             return '{:<4.2}: ref {}, candidate {}'.format(self.plagiarism_percent,
                                                           self.info_ref.func_name + '<' + str(
-                                                              self.info_ref.func_node.lineno) + ':' + str(
-                                                              self.info_ref.func_node.col_offset) + '>',
+                                                              self.info_ref.lineno) + ':' + str(
+                                                              self.info_ref.col_offset) + '>',
                                                           self.info_candidate.func_name + '<' + str(
-                                                              self.info_candidate.func_node.lineno) + ':' + str(
-                                                              self.info_candidate.func_node.col_offset) + '>')
-        return '{:<4.2}: ref {}, candidate {}'.format(0, None, None)
+                                                              self.info_candidate.lineno) + ':' + str(
+                                                              self.info_candidate.col_offset) + '>')
+        return '{:<4.2}: ref {}, candidate {}'.format(0.0, None, None)
 
 
 class UnifiedDiff(object):
@@ -379,71 +1055,202 @@ class UnifiedDiff(object):
     Line diff algorithm to formatted AST string lines, naive but efficiency, result is good enough.
     """
 
+    with_tree = False
+
     @staticmethod
     def diff(a, b):
         """
         Simpler and faster implementation of difflib.unified_diff.
         """
+        return UnifiedDiff.diff_counts(a, b)[0]
+
+    @staticmethod
+    def diff_counts(a, b):
+        """
+        The deleted ('-') and inserted ('+') line counts of one diff pass, the
+        lines of a missing from b and the lines of b missing from a.
+        """
         assert a is not None
         assert b is not None
-        a = a.func_ast_lines
-        b = b.func_ast_lines
-
-        def _gen():
-            for group in difflib.SequenceMatcher(None, a, b).get_grouped_opcodes(0):
-                for tag, i1, i2, j1, j2 in group:
-                    if tag == 'equal':
-                        for line in a[i1:i2]:
-                            yield ''
-                        continue
-                    if tag in ('replace', 'delete'):
-                        for line in a[i1:i2]:
-                            yield '-'
-                    if tag in ('replace', 'insert'):
-                        for line in b[j1:j2]:
-                            yield '+'
-
-        return collections.Counter(_gen())['-']
+        deleted = inserted = 0
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a.func_ast_lines, b.func_ast_lines).get_opcodes():
+            if tag != 'equal':
+                deleted += i2 - i1
+                inserted += j2 - j1
+        return deleted, inserted
 
     @staticmethod
     def total(a, b):
         assert a is not None  # b may be None
         return len(a.func_ast_lines)
 
+    @staticmethod
+    def lower_bounds(a, candidates):
+        """
+        A lower bound of diff(a, b) for every b of candidates, without diffing.
+
+        A diff cannot match more lines than a and b have in common as
+        multisets, so at least the rest of the lines of a are deleted. Two
+        distinct lines with the same hash only make the bound looser.
+        """
+        counts = dict(a.line_counts)
+        size = len(a.func_ast_lines)
+        return [size - sum(min(count, counts.get(line_hash, 0)) for line_hash, count in b.line_counts)
+                for b in candidates]
+
+    @staticmethod
+    def resolve():
+        pass  # difflib is always available
+
+
+def _tree_children(node):
+    return node[1]
+
+def _tree_insert_cost(node):
+    return 0
+
+def _tree_remove_cost(node):
+    return 0 if node[0] == '' else 1
+
+def _tree_update_cost(a, b):
+    return 0 if a[0] == b[0] else 1
 
 class TreeDiff(object):
     """
     Tree edit distance algorithm to AST, very slow and the result is not good for small functions.
     """
 
+    with_tree = True
+    _distance = None
+
+    @staticmethod
+    def resolve():
+        """
+        Import the zss engine once, ImportError if it is not installed.
+        """
+        if TreeDiff._distance is None:
+            import zss
+            TreeDiff._distance = zss.distance
+        return TreeDiff._distance
+
     @staticmethod
     def diff(a, b):
         assert a is not None
         assert b is not None
+        distance = TreeDiff._distance or TreeDiff.resolve()
+        return distance(a.func_tree, b.func_tree, _tree_children,
+                        _tree_insert_cost, _tree_remove_cost, _tree_update_cost)
 
-        def _str_dist(i, j):
-            return 0 if i == j else 1
-
-        def _get_label(n):
-            return type(n).__name__
-
-        def _get_children(n):
-            if not hasattr(n, 'children'):
-                n.children = list(ast.iter_child_nodes(n))
-            return n.children
+    @staticmethod
+    def diff_counts(a, b):
+        # the edit distance is not symmetric, it takes a pass per direction
+        return TreeDiff.diff(a, b), TreeDiff.diff(b, a)
 
-        import zss
-        res = zss.distance(a.func_node, b.func_node, _get_children,
-                           lambda node: 0,  # insert cost
-                           lambda node: _str_dist(_get_label(node), ''),  # remove cost
-                           lambda _a, _b: _str_dist(_get_label(_a), _get_label(_b)), )  # update cost
-        return res
+    @staticmethod
+    def lower_bounds(a, candidates):
+        return [0] * len(candidates)
 
     @staticmethod
     def total(a, b):
         #  The count of AST nodes in referenced function
         assert a is not None  # b may be None
-        return a.func_node.nsubnodes
+        return a.nsubnodes
+
+
+def _scale(count, total, size):
+    """
+    count out of total, as a whole number out of size.
+    """
+    return min(size, int(round(count * size / float(total)))) if total else 0
+
+class AdaptiveDiff(object):
+    """
+    Picks the engine of every function pair from the sizes of both functions.
+
+    The tree edit distance for small trees, whose few AST lines make noisy
+    line diffs, the line diff for medium functions and the overlap of the
+    line fingerprints (line_counts) for very large ones. The budgets bound
+    the work of an engine on one pair, the product of the node counts for
+    the tree edit distance and of the line counts for the line diff, so a
+    pair's worst case time is bounded and the choice of the engine does not
+    depend on the load of the machine. The tree edit distance is only used
+    if zss is installed.
+
+    Every engine is scaled to AST lines, so pairs scored by different
+    engines are comparable and total is the same as UnifiedDiff's.
+    """
+
+    TREE_BUDGET = 50 * 50
+    UNIFIED_BUDGET = 500 * 500
+    ENGINES = ('tree', 'unified', 'fingerprint')
+
+    with_tree = False  # set by resolve
+
+    @staticmethod
+    def resolve():
+        try:
+            TreeDiff.resolve()
+        except ImportError:
+            AdaptiveDiff.with_tree = False
+        else:
+            AdaptiveDiff.with_tree = True
+
+    @staticmethod
+    def engine(a, b):
+        """
+        :return: the name of the engine of the pair, one of ENGINES
+        """
+        if a.has_tree and b.has_tree and a.nsubnodes * b.nsubnodes <= AdaptiveDiff.TREE_BUDGET:
+            return 'tree'
+        if len(a.func_ast_lines) * len(b.func_ast_lines) <= AdaptiveDiff.UNIFIED_BUDGET:
+            return 'unified'
+        return 'fingerprint'
+
+    @staticmethod
+    def diff(a, b):
+        engine = AdaptiveDiff.engine(a, b)
+        if engine == 'tree':
+            return _scale(TreeDiff.diff(a, b), a.nsubnodes, len(a.func_ast_lines))
+        if engine == 'unified':
+            return UnifiedDiff.diff(a, b)
+        return UnifiedDiff.lower_bounds(a, [b])[0]
+
+    @staticmethod
+    def diff_counts(a, b):
+        engine = AdaptiveDiff.engine(a, b)
+        if engine == 'tree':
+            deleted, inserted = TreeDiff.diff_counts(a, b)
+            return (_scale(deleted, a.nsubnodes, len(a.func_ast_lines)),
+                    _scale(inserted, b.nsubnodes, len(b.func_ast_lines)))
+        if engine == 'unified':
+            return UnifiedDiff.diff_counts(a, b)
+        return UnifiedDiff.lower_bounds(a, [b])[0], UnifiedDiff.lower_bounds(b, [a])[0]
+
+    @staticmethod
+    def lower_bounds(a, candidates):
+        # the line diff is bounded like UnifiedDiff's and the fingerprint overlap is that bound, not the tree distance
+        bounds = UnifiedDiff.lower_bounds(a, candidates)
+        return [0 if AdaptiveDiff.engine(a, b) == 'tree' else bound for b, bound in zip(candidates, bounds)]
+
+    @staticmethod
+    def total(a, b):
+        return UnifiedDiff.total(a, b)
+
+
+DIFF_METHODS = collections.OrderedDict([
+    ('unified', UnifiedDiff),
+    ('tree', TreeDiff),  # needs zss and the normalized trees (parse_source with_tree)
+    ('adaptive', AdaptiveDiff),  # TreeDiff only if zss is installed
+])
+
+def resolve_diff_method(name):
+    """
+    :return: the diff class of a --diff-method, its engine imported once; its
+             with_tree tells whether the files are to be parsed with trees
+    """
+    diff_method = DIFF_METHODS[name]
+    diff_method.resolve()
+    return diff_method
 
 
 class NoFuncException(Exception):
@@ -452,54 +1259,304 @@ class NoFuncException(Exception):
         self.source = source
 
 
-class ArgParser(argparse.ArgumentParser):
+def read_file(filename):
+    with get_file(filename) as file:
+        return file.read()
+
+def decode_source(data):
     """
-    A simple ArgumentParser to print help when got error.
+    Decode raw source bytes, honoring a PEP 263 coding cookie or BOM.
+
+    Unknown encodings fall back to utf-8 and undecodable bytes are replaced,
+    so a single bad byte does not abort the run.
+    """
+    try:
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+        return data.decode(encoding, 'replace')
+    except (SyntaxError, LookupError):
+        return data.decode('utf-8', 'replace')
+
+@functools.lru_cache(maxsize=32)
+def source_lines(filename):
     """
+    The code lines of a file, split like parse_source splits them.
 
-    def error(self, message):
-        self.print_help()
-        from gettext import gettext as _
+    FuncInfo reloads its code through here only when it is reported, the
+    cache covers the files of the pairs being reported at a time.
+    """
+    return decode_source(read_file(filename)).splitlines(True)
 
-        self.exit(2, _('\n%s: error: %s\n') % (self.prog, message))
+def group_exact_copies(filename_list, digests):
+    """
+    Collapse byte-identical files.
 
-def compare_files(file1, file2, diff_method=UnifiedDiff):
-    #returns:
-    #         False if it is a syntax Error
-    #         The object if both files are parsable
-    
-    debug_msg = "Processing {} & {}".format(file1, file2) + "..."
-    filename_list = [file1, file2]
-    func_info_list = list()
+    :return: (representatives, groups) where representatives keeps the first
+             file of every distinct content in input order and groups lists
+             every set of two or more identical files
+    """
+    groups = collections.OrderedDict()
     for filename in filename_list:
-        with open(filename) as file:
-            code_str = file.read()
+        groups.setdefault(digests[filename], []).append(filename)
+    representatives = [group[0] for group in groups.values()]
+    return representatives, [group for group in groups.values() if len(group) > 1]
+
+def parse_file(filename):
+    """
+    Parse a file and collect its functions.
+
+    :param filename: path of the python file
+    :return: (True, [FuncInfo, ...]) or (False, filename) on a syntax error
+    """
+    return parse_source(filename, read_file(filename))
+
+ParseResult = collections.namedtuple('ParseResult', 'valid result recovered')
+
+# Lines at column 0 that continue the previous top level block instead of starting a new one.
+_BLOCK_CONTINUATIONS = ('else', 'elif', 'except', 'finally', ')', ']', '}')
+
+def split_blocks(lines, start, stop, indent):
+    """
+    Split lines[start:stop] into blocks of statements starting at the given indent.
+
+    Decorators are kept with the definition that follows them.
+
+    :return: list of (first line index, stop line index)
+    """
+    blocks = []
+    block_start = None
+    decorated = False
+    for index in range(start, stop):
+        line = lines[index]
+        stripped = line.lstrip()
+        if not stripped or stripped.startswith('#') or len(line) - len(stripped) != indent:
+            continue
+        if stripped.startswith(_BLOCK_CONTINUATIONS) or decorated:
+            decorated = stripped.startswith('@')
+            continue
+        if block_start is not None:
+            blocks.append((block_start, index))
+        block_start = index
+        decorated = stripped.startswith('@')
+    if block_start is not None:
+        blocks.append((block_start, stop))
+    return blocks
+
+def _parse_block(lines, start, stop, indent):
+    block = ''.join(line[indent:] for line in lines[start:stop])
+    root_node = ast.parse(block)
+    ast.increment_lineno(root_node, start)
+    if indent:
+        for node in ast.walk(root_node):
+            if isinstance(node, FUNCTION_NODE_TYPES):
+                node.col_offset += indent
+    return root_node
+
+def recover_functions(code_lines, collector, source):
+    """
+    Collect functions from source that fails to parse as a whole.
+
+    Every top level block is parsed on its own and blocks with syntax errors
+    are dropped. Classes with a broken method are split one level further so
+    that their other methods survive.
+    """
+    for start, stop in split_blocks(code_lines, 0, len(code_lines), 0):
+        try:
+            collector.visit(_parse_block(code_lines, start, stop, 0))
+            continue
+        except (SyntaxError, ValueError, RecursionError):
+            pass
+        header = code_lines[start].split('#')[0].strip()
+        if not header.startswith('class ') or not header.endswith(':'):
+            continue
+        class_name = header[len('class '):].split('(')[0].split(':')[0].strip()
+        body_start = start + 1
+        while body_start < stop and not code_lines[body_start].strip():
+            body_start += 1
+        if body_start == stop:
+            continue
+        indent = len(code_lines[body_start]) - len(code_lines[body_start].lstrip())
+        collector._curr_class_names.append(class_name)
+        for sub_start, sub_stop in split_blocks(code_lines, body_start, stop, indent):
             try:
-                root_node = ast.parse(code_str)
-            except SyntaxError as ex:
-                if args.d: print(debug_msg + "Syntax Error!") #"Syntax Error [{}]".format(filename))
-                return False, filename
-            collector = FuncNodeCollector()
-            collector.visit(root_node)
-            code_utf8_lines = code_str.splitlines(True)
-            func_info = [FuncInfo(n, code_utf8_lines) for n in collector.get_function_nodes()]
-            func_info_list.append(func_info)
-
-    #Compare the files
-    func_ast_diff_list = []
-    func_info_ref = func_info_list[0]
-    func_info_candidate = func_info_list[1]
-    for fi1 in func_info_ref:
-        min_diff_value = int((1 << 31) - 1)
-        min_diff_func_info = None
-        for fi2 in func_info_candidate:
-            dv = diff_method.diff(fi1, fi2)
-            if dv < min_diff_value:
+                collector.visit(_parse_block(code_lines, sub_start, sub_stop, indent))
+            except (SyntaxError, ValueError, RecursionError):
+                pass
+        collector._curr_class_names.pop()
+    return collector.get_function_infos(source)
+
+def parse_source(filename, data, with_tree=False, reference=False, profile='default', keep_source=False):
+    """
+    Same as parse_file, for raw source bytes that have already been read.
+
+    :param with_tree: keep the normalized tree of every function for TreeDiff
+    :param reference: use the mutating FuncNodeCollector instead of FuncNormalizer
+    :param profile: name of the NormalizationProfile, ignored by the reference collector
+    :param keep_source: keep the code lines in the FuncInfo instead of
+                        reloading them from filename when they are needed
+    :return: ParseResult; on a syntax error the functions of the parsable
+             top level blocks are recovered and marked as recovered, a file
+             without any recoverable function is a syntax error
+    """
+    code_str = decode_source(data)
+    code_utf8_lines = code_str.splitlines(True)
+    source = code_utf8_lines if keep_source else filename
+    if reference:
+        collector = FuncNodeCollector(with_tree=with_tree)
+    else:
+        collector = FuncNormalizer(with_tree=with_tree, profile=NormalizationProfile.get(profile))
+    try:
+        root_node = ast.parse(code_str)
+    except (SyntaxError, ValueError, RecursionError):  # null bytes, too deeply nested code
+        func_infos = recover_functions(code_utf8_lines, collector, source)
+        if not func_infos:
+            return ParseResult(False, filename, False)
+        return ParseResult(True, func_infos, True)
+    collector.visit(root_node)
+    return ParseResult(True, collector.get_function_infos(source), False)
+
+class ParseCache(object):
+    """
+    On disk cache of normalized parse results keyed by the digest of the file bytes.
+
+    The key includes the interpreter version because the AST layout differs
+    between python versions, the profile id because every profile dumps
+    the same source differently and whether the trees of TreeDiff are kept.
+    """
+
+    VERSION = 4  # 4: match capture names are dropped
+
+    def __init__(self, directory, profile='default', with_tree=False):
+        self._directory = directory
+        self._profile_id = NormalizationProfile.get(profile).profile_id
+        self._with_tree = with_tree
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        key = '{}-py{}{}-{}{}-v{}'.format(digest, sys.version_info[0], sys.version_info[1], self._profile_id,
+                                          '-tree' if self._with_tree else '', self.VERSION)
+        return os.path.join(self._directory, key + '.pickle')
+
+    def get(self, filename, digest):
+        import pickle
+        try:
+            with open(self._path(digest), 'rb') as file:
+                valid, func_infos, recovered = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if valid:
+            # the entry may have been cached from another file with the same bytes
+            for func_info in func_infos:
+                func_info._source = filename
+        return ParseResult(valid, func_infos if valid else filename, recovered)
+
+    def put(self, digest, parsed):
+        import pickle
+        import tempfile
+        fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((parsed.valid, parsed.result if parsed.valid else None, parsed.recovered), file,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self._path(digest))
+
+def load_source(filename, data, cache_dir=None, profile='default', with_tree=False):
+    """
+    parse_source through the ParseCache in cache_dir, if any.
+    """
+    if cache_dir is None:
+        return parse_source(filename, data, with_tree=with_tree, profile=profile)
+    cache = ParseCache(cache_dir, profile, with_tree)
+    digest = hashlib.sha1(data).hexdigest()
+    parsed = cache.get(filename, digest)
+    if parsed is None:
+        parsed = parse_source(filename, data, with_tree=with_tree, profile=profile)
+        cache.put(digest, parsed)
+    return parsed
+
+_NO_MATCH = int((1 << 31) - 1)
+
+def compare_func_infos(func_info_ref, func_info_candidate, diff_method=UnifiedDiff, cutoff=None, complete=True):
+    """
+    Match every referenced function against its most similar candidate function.
+
+    The candidates of a function are diffed in the order of the lower bounds
+    of their diff (diff_method.lower_bounds), and the remaining ones are
+    skipped as soon as their bound shows that none of them can be a better
+    match. Ties go to the first candidate, as when all of them are diffed.
+
+    With a cutoff the referenced functions are diffed largest first while the
+    plagiarized and the remaining total counts are kept, and the pair is
+    given up as soon as it can no longer reach the cutoff.
+
+    :param cutoff: percent_plagiarized the file pair has to reach, or None
+    :param complete: if False, also stop once the pair is certain to reach
+                     the cutoff; the functions not diffed yet are left out
+    :return: list of FuncDiffInfo sorted by plagiarism_percent, highest
+             first, or None if the pair cannot reach the cutoff
+    """
+    best_matches = [None] * len(func_info_ref)
+    order = range(len(func_info_ref))
+    if cutoff is not None:
+        totals = [diff_method.total(fi1, None) for fi1 in func_info_ref]
+        order = sorted(order, key=lambda index: totals[index], reverse=True)
+        grand_total = sum(totals)
+        remaining_count = grand_total
+        plagiarism_count = 0
+    for index in order:
+        fi1 = func_info_ref[index]
+        min_diff_value = _NO_MATCH
+        min_diff_position = len(func_info_candidate)
+        bounds = diff_method.lower_bounds(fi1, func_info_candidate)
+        for position in sorted(range(len(func_info_candidate)), key=lambda position: (bounds[position], position)):
+            if (bounds[position], position) > (min_diff_value, min_diff_position):
+                break  # neither this candidate nor the following ones can do better
+            dv = diff_method.diff(fi1, func_info_candidate[position])
+            if (dv, position) < (min_diff_value, min_diff_position):
                 min_diff_value = dv
-                min_diff_func_info = fi2
-            if dv == 0:  # entire function structure is plagiarized by candidate
+                min_diff_position = position
+        min_diff_func_info = func_info_candidate[min_diff_position] if func_info_candidate else None
+        best_matches[index] = (min_diff_value, min_diff_func_info)
+        if cutoff is not None and grand_total:
+            remaining_count -= totals[index]
+            if min_diff_func_info is not None:
+                plagiarism_count += totals[index] - min_diff_value
+            # the same division as jsonify, so the bound is exact for floats too
+            if (plagiarism_count + remaining_count) / grand_total < cutoff:
+                return None
+            if not complete and plagiarism_count / grand_total >= cutoff:
                 break
+    diffed = [index for index, best_match in enumerate(best_matches) if best_match is not None]
+    return _func_diff_infos([func_info_ref[index] for index in diffed], [best_matches[index] for index in diffed],
+                            diff_method)
+
+def compare_func_infos_symmetric(func_info_ref, func_info_candidate, diff_method=UnifiedDiff):
+    """
+    compare_func_infos in both directions from one diff_counts pass per function pair.
+
+    The deleted lines of a pair score the referenced function, the inserted
+    lines score the candidate function.
 
+    :return: (referenced side, candidate side), both as returned by
+             compare_func_infos; the candidate side has the candidate
+             functions as info_ref
+    """
+    ref_matches = [(_NO_MATCH, None)] * len(func_info_ref)
+    candidate_matches = [(_NO_MATCH, None)] * len(func_info_candidate)
+    for i, fi1 in enumerate(func_info_ref):
+        for j, fi2 in enumerate(func_info_candidate):
+            deleted, inserted = diff_method.diff_counts(fi1, fi2)
+            if deleted < ref_matches[i][0]:
+                ref_matches[i] = (deleted, fi2)
+            if inserted < candidate_matches[j][0]:
+                candidate_matches[j] = (inserted, fi1)
+    return (_func_diff_infos(func_info_ref, ref_matches, diff_method),
+            _func_diff_infos(func_info_candidate, candidate_matches, diff_method))
+
+def _func_diff_infos(func_infos, best_matches, diff_method):
+    """
+    FuncDiffInfo of every function and its (diff value, best matching function), highest plagiarism_percent first.
+    """
+    func_ast_diff_list = []
+    for fi1, (min_diff_value, min_diff_func_info) in zip(func_infos, best_matches):
         func_diff_info = FuncDiffInfo()
         func_diff_info.info_ref = fi1
         func_diff_info.info_candidate = min_diff_func_info
@@ -507,17 +1564,684 @@ def compare_files(file1, file2, diff_method=UnifiedDiff):
         func_diff_info.plagiarism_count = func_diff_info.total_count - min_diff_value if min_diff_func_info else 0
         func_ast_diff_list.append(func_diff_info)
     func_ast_diff_list.sort(key=operator.attrgetter('plagiarism_percent'), reverse=True)
-            
-    #Successfully proessed both files
-    if args.d: print(debug_msg + "Success!")
+    return func_ast_diff_list
+
+def greedy_assignment(weights):
+    """
+    One-to-one pairs of rows and columns, heaviest weight first.
+
+    :param weights: list of rows of non-negative weights
+    :return: list of (row, column)
+    """
+    cells = sorted(((weight, i, j) for i, row in enumerate(weights) for j, weight in enumerate(row)),
+                   key=lambda cell: (-cell[0], cell[1], cell[2]))
+    used_rows = set()
+    used_columns = set()
+    pairs = []
+    for weight, i, j in cells:
+        if i not in used_rows and j not in used_columns:
+            used_rows.add(i)
+            used_columns.add(j)
+            pairs.append((i, j))
+    return pairs
+
+def optimal_assignment(weights):
+    """
+    One-to-one pairs of rows and columns with the largest total weight.
+
+    Uses scipy's linear_sum_assignment if it is installed and a pure python
+    Hungarian algorithm otherwise.
+
+    :param weights: list of rows of non-negative weights
+    :return: list of (row, column)
+    """
+    if not weights or not weights[0]:
+        return []
+    try:
+        import numpy
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        pass
+    else:
+        rows, columns = linear_sum_assignment(-numpy.array(weights, dtype=float))
+        return list(zip(rows.tolist(), columns.tolist()))
+    if len(weights) > len(weights[0]):
+        return [(i, j) for j, i in _hungarian([list(column) for column in zip(*weights)])]
+    return _hungarian(weights)
+
+def _hungarian(weights):
+    """
+    Hungarian algorithm with potentials, O(n^2 m) for n <= m rows and columns.
+
+    Maximizes the total weight by minimizing its negation; every row gets a column.
+    """
+    n = len(weights)
+    m = len(weights[0])
+    inf = float('inf')
+    u = [0] * (n + 1)  # row potentials
+    v = [0] * (m + 1)  # column potentials
+    owner = [0] * (m + 1)  # row (1-based) assigned to a column, column 0 is the row being added
+    way = [0] * (m + 1)
+    for i in range(1, n + 1):
+        owner[0] = i
+        j0 = 0
+        min_reduced = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            row = weights[i0 - 1]
+            u_i0 = u[i0]
+            delta = inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    reduced = -row[j - 1] - u_i0 - v[j]
+                    if reduced < min_reduced[j]:
+                        min_reduced[j] = reduced
+                        way[j] = j0
+                    if min_reduced[j] < delta:
+                        delta = min_reduced[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[owner[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_reduced[j] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:  # flip the augmenting path
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    return [(owner[j] - 1, j - 1) for j in range(1, m + 1) if owner[j]]
+
+MATCH_ASSIGNMENTS = {'greedy': greedy_assignment, 'optimal': optimal_assignment}
+
+def compare_func_infos_assigned(func_info_ref, func_info_candidate, diff_method=UnifiedDiff, match='optimal',
+                                symmetric=False):
+    """
+    Match the functions of both files one to one instead of every referenced
+    function picking its own best candidate.
+
+    The diffs of all function pairs are computed once; a pair weighs its
+    matched referenced lines (plus its matched candidate lines if symmetric)
+    and the pairs are chosen by MATCH_ASSIGNMENTS[match]. Functions left
+    without a partner score 0.
+
+    :return: (referenced side, candidate side or None), as returned by compare_func_infos_symmetric
+    """
+    if symmetric:
+        counts = [[diff_method.diff_counts(fi1, fi2) for fi2 in func_info_candidate] for fi1 in func_info_ref]
+    else:
+        counts = [[(diff_method.diff(fi1, fi2), 0) for fi2 in func_info_candidate] for fi1 in func_info_ref]
+    ref_totals = [diff_method.total(fi1, None) for fi1 in func_info_ref]
+    candidate_totals = [diff_method.total(fi2, None) if symmetric else 0 for fi2 in func_info_candidate]
+    weights = [[ref_totals[i] - deleted + (candidate_totals[j] - inserted if symmetric else 0)
+                for j, (deleted, inserted) in enumerate(row)] for i, row in enumerate(counts)]
+
+    ref_matches = [(_NO_MATCH, None)] * len(func_info_ref)
+    candidate_matches = [(_NO_MATCH, None)] * len(func_info_candidate)
+    for i, j in MATCH_ASSIGNMENTS[match](weights):
+        deleted, inserted = counts[i][j]
+        ref_matches[i] = (deleted, func_info_candidate[j])
+        candidate_matches[j] = (inserted, func_info_ref[i])
+    ref_side = _func_diff_infos(func_info_ref, ref_matches, diff_method)
+    if not symmetric:
+        return ref_side, None
+    return ref_side, _func_diff_infos(func_info_candidate, candidate_matches, diff_method)
+
+def compare_parsed(parsed1, parsed2, diff_method=UnifiedDiff, symmetric=False, match='best', cutoff=None,
+                   complete=True):
+    #returns:
+    #         False if it is a syntax Error
+    #         The object if both files are parsable
+    #         (The object, the candidate side object) if symmetric
+    #         False and an empty list if the pair cannot reach the cutoff
+    for parsed in (parsed1, parsed2):
+        if not parsed.valid:
+            return False, parsed.result
+
+    if match != 'best':
+        func_ast_diff_list, candidate_diff_list = compare_func_infos_assigned(parsed1.result, parsed2.result,
+                                                                              diff_method, match, symmetric)
+        if not func_ast_diff_list:
+            return False, list()
+        return True, (func_ast_diff_list, candidate_diff_list) if symmetric else func_ast_diff_list
+
+    if symmetric:
+        func_ast_diff_list, candidate_diff_list = compare_func_infos_symmetric(parsed1.result, parsed2.result,
+                                                                               diff_method)
+        if func_ast_diff_list:
+            return True, (func_ast_diff_list, candidate_diff_list)
+        return False, list()
+
+    func_ast_diff_list = compare_func_infos(parsed1.result, parsed2.result, diff_method, cutoff, complete)
     #Ensure that there is content in func_ast_diff_list
-    if not func_ast_diff_list == []:
+    if func_ast_diff_list:
         return True, func_ast_diff_list
     else:
         return False, list()
-    # return [{"SUCESS":"True"}]
 
-def jsonify(file1, file2, raw_result):
+def compare_files(file1, file2, diff_method=UnifiedDiff):
+    debug_msg = "Processing {} & {}".format(file1, file2) + "..."
+    parsed1 = parse_file(file1)
+    parsed2 = parse_file(file2) if parsed1.valid else None
+    valid, raw_result = compare_parsed(parsed1, parsed2, diff_method) if parsed2 else parsed1[:2]
+    if args.d: print(debug_msg + ("Success!" if valid or raw_result == [] else "Syntax Error!"))
+    return valid, raw_result
+
+def detect(pycode_string_list, diff_method=UnifiedDiff):
+    """
+    Compare the code of the first string against each of the others, as pycode_similar.detect does.
+
+    :return: list of (candidate index, list of FuncDiffInfo sorted by
+             plagiarism_percent, highest first)
+    """
+    if len(pycode_string_list) < 2:
+        return []
+    diff_method.resolve()
+    parsed = [parse_source('<code {}>'.format(index), code_str.encode('utf-8'), with_tree=diff_method.with_tree,
+                           keep_source=True) for index, code_str in enumerate(pycode_string_list)]
+    if not parsed[0].valid or not parsed[0].result:
+        raise NoFuncException(0)
+    return [(index, compare_func_infos(parsed[0].result, candidate.result if candidate.valid else [], diff_method))
+            for index, candidate in enumerate(parsed[1:], 1)]
+
+def count_pairs(count):
+    return count * (count - 1) // 2
+
+def iter_pair_tiles(count, tile_size):
+    """
+    Lazily split the upper triangle of the count x count pair matrix into tiles.
+
+    Each tile is (row_start, row_stop, col_start, col_stop); only the rows and
+    columns of one tile need to be parsed at a time, so memory is bounded by
+    the tile size instead of the number of pairs.
+    """
+    for row_start in range(0, count, tile_size):
+        row_stop = min(row_start + tile_size, count)
+        for col_start in range(row_start, count, tile_size):
+            yield row_start, row_stop, col_start, min(col_start + tile_size, count)
+
+def iter_tile_pairs(tile):
+    """
+    Yield the (i, j) index pairs, i < j, covered by a tile.
+    """
+    row_start, row_stop, col_start, col_stop = tile
+    for i in range(row_start, row_stop):
+        for j in range(max(i + 1, col_start), col_stop):
+            yield i, j
+
+def count_tile_pairs(tile):
+    row_start, row_stop, col_start, col_stop = tile
+    return sum(max(0, col_stop - max(i + 1, col_start)) for i in range(row_start, row_stop))
+
+def tile_indices(tile):
+    row_start, row_stop, col_start, col_stop = tile
+    return sorted(set(range(row_start, row_stop)) | set(range(col_start, col_stop)))
+
+class FileLoader(object):
+    """
+    Read files concurrently with asyncio and parse them in a worker pool.
+
+    Reads run in a thread pool limited to io_concurrency files in flight, so
+    slow filesystems (NFS etc.) overlap their latency. Every file is handed to
+    the parse pool as soon as it has been read, overlapping I/O with the
+    CPU-bound AST processing. With jobs <= 1 the files are parsed in the
+    calling thread. The parse pool is a process pool, or with the thread
+    backend a thread pool that hands the results back without pickling them
+    (a speedup on free-threaded builds only).
+
+    The event loop and the pools are only started by the first batch that
+    needs them: with jobs <= 1, batches of up to SERIAL_BATCH files are read
+    and parsed in the calling thread, so a run on a couple of files does not
+    pay for importing asyncio and starting threads.
+
+    digest keeps the bytes it reads, up to READ_BUFFER bytes in all, and load
+    parses those instead of reading the files again. The files past the
+    budget are read again by every load, so the memory stays bounded as with
+    the tiles.
+    """
+
+    SERIAL_BATCH = 4
+    READ_BUFFER = 64 * 1024 * 1024
+
+    def __init__(self, io_concurrency=16, jobs=1, cache_dir=None, profile='default', with_tree=False,
+                 backend='process'):
+        self._io_concurrency = io_concurrency
+        self._jobs = jobs
+        self._backend = backend
+        self._cache_dir = cache_dir
+        self._profile = profile
+        self._with_tree = with_tree
+        self._loop = None
+        self._io_pool = None
+        self._parse_pool = None
+        self._buffer = {}
+        self._buffered = 0
+
+    def _serial(self, filenames):
+        return self._jobs <= 1 and len(filenames) <= self.SERIAL_BATCH
+
+    def _start(self):
+        if self._loop is None:
+            import asyncio
+            import concurrent.futures
+            self._loop = asyncio.new_event_loop()
+            self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._io_concurrency)
+            if self._jobs > 1:
+                self._parse_pool = new_executor(self._jobs, self._backend)
+        return self._loop
+
+    def load(self, filenames):
+        """
+        :return: dict of filename to the parse_file result
+        """
+        if not filenames:
+            return {}
+        if self._serial(filenames):
+            return dict((filename, load_source(filename, self._read(filename), self._cache_dir, self._profile,
+                                               self._with_tree)) for filename in filenames)
+        return dict(self._start().run_until_complete(self._load_all(filenames)))
+
+    def _read(self, filename):
+        data = self._buffer.get(filename)
+        return data if data is not None else read_file(filename)
+
+    async def _load_all(self, filenames):
+        import asyncio
+        semaphore = asyncio.Semaphore(self._io_concurrency)
+        return await asyncio.gather(*[self._load_one(semaphore, filename) for filename in filenames])
+
+    async def _load_one(self, semaphore, filename):
+        data = self._buffer.get(filename)
+        if data is None:
+            async with semaphore:
+                data = await self._loop.run_in_executor(self._io_pool, read_file, filename)
+        if self._parse_pool is None:
+            return filename, load_source(filename, data, self._cache_dir, self._profile, self._with_tree)
+        return filename, await self._loop.run_in_executor(self._parse_pool, load_source, filename, data,
+                                                          self._cache_dir, self._profile, self._with_tree)
+
+    def digest(self, filenames):
+        """
+        :return: dict of filename to the sha1 of its bytes
+        """
+        self._buffer = {}
+        self._buffered = 0
+        if not filenames:
+            return {}
+        if self._serial(filenames):
+            return dict((filename, self._digest(filename, read_file(filename))) for filename in filenames)
+        return dict(self._start().run_until_complete(self._digest_all(filenames)))
+
+    def _digest(self, filename, data):
+        if self._buffered + len(data) <= self.READ_BUFFER:
+            self._buffer[filename] = data
+            self._buffered += len(data)
+        return hashlib.sha1(data).hexdigest()
+
+    async def _digest_all(self, filenames):
+        import asyncio
+        semaphore = asyncio.Semaphore(self._io_concurrency)
+        return await asyncio.gather(*[self._digest_one(semaphore, filename) for filename in filenames])
+
+    async def _digest_one(self, semaphore, filename):
+        async with semaphore:
+            data = await self._loop.run_in_executor(self._io_pool, read_file, filename)
+        return filename, self._digest(filename, data)
+
+    def close(self):
+        if self._loop is None:
+            return
+        self._io_pool.shutdown()
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+        self._loop.close()
+
+def resolve_backend(backend):
+    """
+    :return: 'thread' or 'process'; auto picks threads on free-threaded builds
+    """
+    if backend == 'auto':
+        gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+        return 'process' if gil_enabled else 'thread'
+    return backend
+
+def _init_worker(options):
+    global args
+    args = options
+
+def new_executor(jobs, backend):
+    """
+    A pool of jobs threads or processes; worker processes get the options of the run.
+    """
+    import concurrent.futures
+    if resolve_backend(backend) == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                  initargs=(globals().get('args'),))
+
+class TileCache(object):
+    """
+    Parsed files of the current tile, keyed by file index.
+
+    Files shared with the previous tile (the row band) are kept, everything
+    else is released, so at most two tiles worth of files are held at once.
+    """
+
+    def __init__(self, filename_list, loader):
+        self._filename_list = filename_list
+        self._loader = loader
+        self._parsed = {}
+
+    def load(self, tile):
+        indices = tile_indices(tile)
+        wanted = set(indices)
+        for index in list(self._parsed):
+            if index not in wanted:
+                del self._parsed[index]
+        missing = [index for index in indices if index not in self._parsed]
+        loaded = self._loader.load([self._filename_list[index] for index in missing])
+        for index in missing:
+            self._parsed[index] = loaded[self._filename_list[index]]
+
+    def __getitem__(self, index):
+        return self._parsed[index]
+
+class UnionFind(object):
+    """
+    Disjoint sets of the integers 0..size-1, with path halving and union by size.
+    """
+
+    def __init__(self, size):
+        self._parent = list(range(size))
+        self._size = [1] * size
+
+    def find(self, item):
+        parent = self._parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        """
+        :return: False if a and b already were in the same set
+        """
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return False
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+        return True
+
+    def groups(self):
+        """
+        :return: list of sets as sorted lists, ordered by their smallest item
+        """
+        groups = collections.OrderedDict()
+        for item in range(len(self._parent)):
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
+
+def _line_tokens(lines):
+    """
+    The lines as a set of tokens, the k-th occurrence of a line being (line, k).
+    """
+    seen = collections.Counter()
+    tokens = []
+    for line in lines:
+        tokens.append((line, seen[line]))
+        seen[line] += 1
+    return tokens
+
+def cluster_functions(func_infos, threshold):
+    """
+    Group near-identical functions of the whole corpus into clone families.
+
+    Functions with the same struct_hash are merged without diffing. The
+    remaining edges join functions whose UnifiedDiff matched AST lines cover
+    at least threshold of the larger function. They are found by prefix
+    filtering: the matched lines are at most the common lines of both
+    functions, so two functions that reach the threshold share one of the
+    size - ceil(threshold * size) + 1 rarest lines of each of them. Only
+    functions sharing such a line and of compatible size are diffed.
+
+    :param func_infos: list of FuncInfo
+    :param threshold: minimum similarity of an edge, 0 < threshold <= 1
+    :return: list of families, each a list of indices into func_infos
+    """
+    union_find = UnionFind(len(func_infos))
+    first_of_hash = collections.OrderedDict()
+    for index, func_info in enumerate(func_infos):
+        first = first_of_hash.setdefault(func_info.struct_hash, index)
+        if first != index:
+            union_find.union(first, index)
+
+    representatives = list(first_of_hash.values())
+    tokens = dict((index, _line_tokens(func_infos[index].func_ast_lines)) for index in representatives)
+    frequency = collections.Counter(token for index in representatives for token in tokens[index])
+    postings = collections.defaultdict(list)
+    for i in representatives:
+        size_i = len(tokens[i])
+        prefix = sorted(tokens[i], key=lambda token: (frequency[token], token))
+        prefix = prefix[:size_i - int(math.ceil(threshold * size_i)) + 1]
+        candidates = set()
+        for token in prefix:
+            candidates.update(postings[token])
+            postings[token].append(i)
+        for j in sorted(candidates):
+            size_j = len(tokens[j])
+            small, large = (i, j) if size_i <= size_j else (j, i)
+            size_small, size_large = min(size_i, size_j), max(size_i, size_j)
+            if size_small < threshold * size_large:
+                continue  # matched lines <= size of the smaller function
+            if union_find.find(i) == union_find.find(j):
+                continue
+            if size_small - UnifiedDiff.diff(func_infos[small], func_infos[large]) >= threshold * size_large:
+                union_find.union(i, j)
+    return [family for family in union_find.groups() if len(family) > 1]
+
+def collect_functions(filename_list, loader, results, event_stream=None, min_lines=0):
+    """
+    Load every file, tile by tile, and list its functions of at least min_lines AST lines.
+
+    Files that fail to parse or were recovered are added to results.
+
+    :return: (owners, func_infos), the file of every function and its FuncInfo
+    """
+    progress = ProgressReporter(len(filename_list), interval=args.progress_interval, event_stream=event_stream)
+    progress.start()
+    owners = []
+    func_infos = []
+    for start in range(0, len(filename_list), args.tile_size):
+        chunk = filename_list[start:start + args.tile_size]
+        loaded = loader.load(chunk)
+        for filename in chunk:
+            parsed = loaded[filename]
+            if not parsed.valid:
+                results["syntax_errors"].append(filename)
+            else:
+                if parsed.recovered:
+                    results["recovered"].append(filename)
+                for func_info in parsed.result:
+                    if len(func_info.func_ast_lines) >= min_lines:
+                        owners.append(filename)
+                        func_infos.append(func_info)
+            progress.advance()
+    progress.finish()
+    return owners, func_infos
+
+def cluster_batch(filename_list, loader, results, event_stream=None):
+    """
+    Load every file and report its functions' clone families in results["clusters"].
+
+    Functions with fewer than -l AST lines are left out, families are only
+    reported when they span two or more files.
+    """
+    owners, func_infos = collect_functions(filename_list, loader, results, event_stream, args.l)
+    for family in cluster_functions(func_infos, args.cluster_threshold):
+        files = set(owners[index] for index in family)
+        if len(files) < 2:
+            continue
+        results["clusters"].append({
+            "size": len(family),
+            "files": len(files),
+            "members": [{
+                "file": owners[index],
+                "name": func_infos[index].func_name,
+                "line": func_infos[index].lineno,
+                "col": func_infos[index].col_offset
+            } for index in family]
+        })
+    results["clusters"].sort(key=lambda cluster: cluster["size"], reverse=True)
+
+def suffix_array(tokens):
+    """
+    Suffix array of a sequence of integers, by prefix doubling.
+
+    Each round sorts the suffixes by the ranks of their first 2k tokens and
+    stops as soon as all ranks are distinct, so the number of rounds grows
+    with the log of the longest repeat rather than of the corpus.
+
+    :return: list of the start positions of the suffixes in sorted order
+    """
+    count = len(tokens)
+    order = sorted(range(count), key=tokens.__getitem__)
+    rank = [0] * count
+    distinct = 0
+    for position in range(1, count):
+        if tokens[order[position]] != tokens[order[position - 1]]:
+            distinct += 1
+        rank[order[position]] = distinct
+    k = 1
+    while distinct < count - 1:
+        keys = [rank[i] * (count + 1) + (rank[i + k] + 1 if i + k < count else 0) for i in range(count)]
+        order.sort(key=keys.__getitem__)
+        distinct = 0
+        rank[order[0]] = 0
+        for position in range(1, count):
+            if keys[order[position]] != keys[order[position - 1]]:
+                distinct += 1
+            rank[order[position]] = distinct
+        k *= 2
+    return order
+
+def lcp_array(tokens, order):
+    """
+    Longest common prefix of every suffix with the one before it in order (Kasai et al.).
+
+    :return: list where lcp[i] is the common prefix length of order[i - 1] and order[i], lcp[0] = 0
+    """
+    count = len(tokens)
+    rank = [0] * count
+    for position, start in enumerate(order):
+        rank[start] = position
+    lcp = [0] * count
+    length = 0
+    for start in range(count):
+        if rank[start] == 0:
+            length = 0
+            continue
+        other = order[rank[start] - 1]
+        while start + length < count and other + length < count and tokens[start + length] == tokens[other + length]:
+            length += 1
+        lcp[rank[start]] = length
+        if length:
+            length -= 1
+    return lcp
+
+def shared_fragments(func_infos, owners, min_length):
+    """
+    Find the runs of normalized AST lines that functions of two or more files have in common.
+
+    The AST lines of all functions are numbered and concatenated into one
+    corpus, each function followed by a separator of its own so that no run
+    spans two functions. The lcp intervals of the corpus' suffix array are
+    its repeats; every one of at least min_length lines that is left
+    maximal (its occurrences are not all preceded by the same line, which
+    would make it part of a longer repeat) is a fragment.
+
+    :param func_infos: list of FuncInfo
+    :param owners: the file of every function of func_infos
+    :param min_length: minimum number of AST lines of a fragment
+    :return: list of (length, [(index into func_infos, offset of the first line)])
+    """
+    ids = {}
+    tokens = []
+    starts = []
+    for func_info in func_infos:
+        starts.append(len(tokens))
+        tokens.extend(ids.setdefault(line.strip(), len(ids)) for line in func_info.func_ast_lines)
+        tokens.append(-len(starts))  # separator, unique to the function
+    if not tokens:
+        return []
+    order = suffix_array(tokens)
+    lcp = lcp_array(tokens, order)
+
+    def _occurrence(start):
+        index = bisect.bisect_right(starts, start) - 1
+        return index, start - starts[index]
+
+    fragments = []
+    stack = [(0, 0)]  # open lcp intervals as (length, left bound)
+    for position in range(1, len(tokens) + 1):
+        length = lcp[position] if position < len(tokens) else 0
+        left = position - 1
+        while length < stack[-1][0]:
+            interval_length, left = stack.pop()
+            if interval_length < min_length:
+                continue
+            occurrence_starts = order[left:position]
+            if len(set(tokens[start - 1] if start else None for start in occurrence_starts)) < 2:
+                continue
+            occurrences = sorted(_occurrence(start) for start in occurrence_starts)
+            if len(set(owners[index] for index, _ in occurrences)) > 1:
+                fragments.append((interval_length, occurrences))
+        if length > stack[-1][0]:
+            stack.append((length, left))
+    return fragments
+
+def fragment_batch(filename_list, loader, results, event_stream=None):
+    """
+    Load every file and report the fragments its functions share with other files in results["fragments"].
+    """
+    owners, func_infos = collect_functions(filename_list, loader, results, event_stream)
+    for length, occurrences in shared_fragments(func_infos, owners, args.fragment_length):
+        results["fragments"].append({
+            "length": length,
+            "files": len(set(owners[index] for index, _ in occurrences)),
+            "occurrences": [{
+                "file": owners[index],
+                "name": func_infos[index].func_name,
+                "line": func_infos[index].lineno,
+                "col": func_infos[index].col_offset,
+                "ast_offset": offset
+            } for index, offset in occurrences]
+        })
+    results["fragments"].sort(key=lambda fragment: (fragment["length"], len(fragment["occurrences"])), reverse=True)
+
+def reported_functions(raw_result, ast_lower_bound, plag_lower_bound):
+    """
+    The functions of a comparison that are reported: matched to a function of
+    the other file, with at least ast_lower_bound AST lines and at least
+    plag_lower_bound plagiarized.
+    """
+    return [func_diff_info for func_diff_info in raw_result
+            if func_diff_info.info_candidate is not None and
+            len(func_diff_info.info_ref.func_ast_lines) >= ast_lower_bound and
+            func_diff_info.plagiarism_percent >= plag_lower_bound]
+
+def jsonify(file1, file2, raw_result, functions=None, candidate_result=None):
+    # functions, if given, collects the reported functions as dicts
+    # candidate_result, if given, is the candidate side of a symmetric comparison
     curr_result = {}
     curr_result["ref"] = file1
     curr_result["candidate"] = file2
@@ -528,79 +2252,1413 @@ def jsonify(file1, file2, raw_result):
     curr_result["PLAG_lower_bound"] = args.p
     curr_result["diff_list"] = list()
 
-    for func_diff_info in raw_result:
-        if len(func_diff_info.info_ref.func_ast_lines) >= args.l and func_diff_info.plagiarism_percent >= args.p:
+    for func_diff_info in reported_functions(raw_result, args.l, args.p):
+        curr_result["diff_list"].append(str(func_diff_info))
+        # the function dicts are only built for the writers, the code itself is left to --report
+        if functions is not None:
             curr_func = {}
             curr_func["percent_plagiarized"] = func_diff_info.plagiarism_percent
             curr_func["ref_func"] = {
                 "name": func_diff_info.info_ref.func_name,
-                "line": func_diff_info.info_ref.func_node.lineno,
-                "col":func_diff_info.info_ref.func_node.col_offset
+                "line": func_diff_info.info_ref.lineno,
+                "col":func_diff_info.info_ref.col_offset
 
             }
             curr_func["candidate_func"] = {
                 "name": func_diff_info.info_candidate.func_name,
-                "line": func_diff_info.info_candidate.func_node.lineno,
-                "col":func_diff_info.info_candidate.func_node.col_offset
+                "line": func_diff_info.info_candidate.lineno,
+                "col":func_diff_info.info_candidate.col_offset
 
             }
-            curr_result["diff_list"].append(str(func_diff_info))
-            # curr_result["diff_list"].append(curr_func) # Uncomment to have everything in nice json format        
+            functions.append(curr_func)
+
+    if args.diff_method == 'adaptive':
+        engines = collections.Counter(AdaptiveDiff.engine(func_diff_info.info_ref, func_diff_info.info_candidate)
+                                      for func_diff_info in raw_result if func_diff_info.info_candidate is not None)
+        curr_result["engines"] = dict((engine, engines[engine]) for engine in AdaptiveDiff.ENGINES if engines[engine])
+
+    if candidate_result is not None:
+        candidate_total = sum(func_diff_info.total_count for func_diff_info in candidate_result)
+        candidate_count = sum(func_diff_info.plagiarism_count for func_diff_info in candidate_result)
+        curr_result["percent_ref"] = curr_result["percent_plagiarized"]
+        curr_result["percent_candidate"] = candidate_count / candidate_total if candidate_total else 0
+        # a file copied into a larger one scores high on the side of the smaller file only
+        curr_result["percent_combined"] = max(curr_result["percent_ref"], curr_result["percent_candidate"])
+        curr_result["candidate_diff_list"] = [str(func_diff_info) for func_diff_info in
+                                              reported_functions(candidate_result, args.l, args.p)]
     return curr_result
 
+class ResultWriter(object):
+    """
+    Streams the results to a tabular output instead of one JSON document.
+
+    run_batch hands every detected pair to add_pair as soon as it is scored,
+    so the pairs are never all held in memory; close gets the remaining,
+    small parts of the results (configuration, syntax_errors, ...).
+    """
+
+    PAIR_COLUMNS = ('ref', 'candidate', 'plagiarism_count', 'total_count', 'percent_plagiarized',
+                    'percent_candidate', 'percent_combined')
+    FUNCTION_COLUMNS = ('ref', 'candidate', 'percent_plagiarized', 'ref_name', 'ref_line', 'ref_col',
+                        'candidate_name', 'candidate_line', 'candidate_col')
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def _function_row(pair, func):
+        return (pair["ref"], pair["candidate"], func["percent_plagiarized"],
+                func["ref_func"]["name"], func["ref_func"]["line"], func["ref_func"]["col"],
+                func["candidate_func"]["name"], func["candidate_func"]["line"], func["candidate_func"]["col"])
+
+    def add_pair(self, pair, functions):
+        """
+        :param pair: the jsonify result of the pair
+        :param functions: the function dicts jsonify collected for the pair
+        """
+        raise NotImplementedError
+
+    def close(self, results):
+        raise NotImplementedError
+
+class CsvWriter(ResultWriter):
+    """
+    One row per pair in path and one row per reported function pair in
+    <path root>.functions<ext>; everything else goes to <path root>.meta.json.
+    """
+
+    def __init__(self, path, delimiter=','):
+        import csv
+        super(CsvWriter, self).__init__(path)
+        root, ext = os.path.splitext(path)
+        self.functions_path = root + '.functions' + ext
+        self.meta_path = root + '.meta.json'
+        self._pair_file = open(path, 'w', newline='')
+        self._function_file = open(self.functions_path, 'w', newline='')
+        self._pairs = csv.writer(self._pair_file, delimiter=delimiter)
+        self._functions = csv.writer(self._function_file, delimiter=delimiter)
+        self._pairs.writerow(self.PAIR_COLUMNS)
+        self._functions.writerow(self.FUNCTION_COLUMNS)
+
+    def add_pair(self, pair, functions):
+        self._pairs.writerow([pair.get(column) for column in self.PAIR_COLUMNS])
+        self._functions.writerows(self._function_row(pair, func) for func in functions)
+
+    def close(self, results):
+        self._pair_file.close()
+        self._function_file.close()
+        with open(self.meta_path, 'w') as outfile:
+            json.dump(dict((key, value) for key, value in results.items() if key != "detected"), outfile)
+
+class SqliteWriter(ResultWriter):
+    """
+    Pairs and reported function pairs in an SQLite database, indexed for
+    lookups by file and score. The other parts of the results are JSON
+    values of the meta table, clone families are rows of cluster_members
+    and shared fragments rows of fragment_occurrences.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE pairs (
+            id INTEGER PRIMARY KEY,
+            ref TEXT NOT NULL,
+            candidate TEXT NOT NULL,
+            plagiarism_count INTEGER NOT NULL,
+            total_count INTEGER NOT NULL,
+            percent_plagiarized REAL NOT NULL,
+            percent_candidate REAL,
+            percent_combined REAL
+        );
+        CREATE TABLE functions (
+            pair_id INTEGER NOT NULL REFERENCES pairs (id),
+            percent_plagiarized REAL NOT NULL,
+            ref_name TEXT NOT NULL,
+            ref_line INTEGER NOT NULL,
+            ref_col INTEGER NOT NULL,
+            candidate_name TEXT NOT NULL,
+            candidate_line INTEGER NOT NULL,
+            candidate_col INTEGER NOT NULL
+        );
+        CREATE TABLE cluster_members (
+            cluster_id INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            name TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            col INTEGER NOT NULL
+        );
+        CREATE TABLE fragment_occurrences (
+            fragment_id INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            file TEXT NOT NULL,
+            name TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            col INTEGER NOT NULL,
+            ast_offset INTEGER NOT NULL
+        );
+        CREATE TABLE meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    '''
+    # Created after the bulk insert, which is faster than maintaining them row by row.
+    INDEXES = '''
+        CREATE INDEX pairs_ref ON pairs (ref, percent_plagiarized);
+        CREATE INDEX pairs_candidate ON pairs (candidate, percent_plagiarized);
+        CREATE INDEX pairs_percent ON pairs (percent_plagiarized);
+        CREATE INDEX functions_pair ON functions (pair_id);
+        CREATE INDEX functions_percent ON functions (percent_plagiarized);
+        CREATE INDEX cluster_members_file ON cluster_members (file);
+        CREATE INDEX fragment_occurrences_file ON fragment_occurrences (file);
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        super(SqliteWriter, self).__init__(path)
+        if os.path.exists(path):
+            os.remove(path)
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(self.SCHEMA)
+
+    def add_pair(self, pair, functions):
+        cursor = self._connection.execute(
+            'INSERT INTO pairs ({}) VALUES ({})'.format(', '.join(self.PAIR_COLUMNS), ', '.join('?' * len(self.PAIR_COLUMNS))),
+            [pair.get(column) for column in self.PAIR_COLUMNS])
+        self._connection.executemany(
+            'INSERT INTO functions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((cursor.lastrowid,) + self._function_row(pair, func)[2:] for func in functions))
+
+    def close(self, results):
+        connection = self._connection
+        for cluster_id, cluster in enumerate(results.get("clusters", ())):
+            connection.executemany(
+                'INSERT INTO cluster_members VALUES (?, ?, ?, ?, ?)',
+                ((cluster_id, member["file"], member["name"], member["line"], member["col"])
+                 for member in cluster["members"]))
+        for fragment_id, fragment in enumerate(results.get("fragments", ())):
+            connection.executemany(
+                'INSERT INTO fragment_occurrences VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((fragment_id, fragment["length"], occurrence["file"], occurrence["name"], occurrence["line"],
+                  occurrence["col"], occurrence["ast_offset"]) for occurrence in fragment["occurrences"]))
+        connection.executemany(
+            'INSERT INTO meta VALUES (?, ?)',
+            ((key, json.dumps(value)) for key, value in results.items()
+             if key not in ("detected", "clusters", "fragments")))
+        connection.executescript(self.INDEXES)
+        connection.commit()
+        connection.close()
+
+OUTPUT_FORMATS = collections.OrderedDict([
+    ('json', None),  # save_json_file
+    ('csv', CsvWriter),
+    ('tsv', lambda path: CsvWriter(path, delimiter='\t')),
+    ('sqlite', SqliteWriter),
+])
+
+class PairRecorder(object):
+    """
+    Forwards the detected pairs to a ResultWriter and keeps their (ref, candidate) for the --report stage.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pairs = []
+
+    def add_pair(self, pair, functions):
+        self.pairs.append((pair["ref"], pair["candidate"]))
+        self.writer.add_pair(pair, functions)
+
+    def close(self, results):
+        self.writer.close(results)
+
+def report_details(pairs):
+    """
+    The matched functions of the detected pairs, with their code.
+
+    Runs after scoring and only on the detected pairs: each file is parsed
+    again (through --cache-dir, if any) with the options of the run, and the
+    code of the functions is read from the source_lines cache on demand.
+
+    :param pairs: iterable of (ref, candidate) file names
+    :return: iterator of (ref, candidate, [FuncDiffInfo, ...]) with the
+             functions jsonify reports, or None instead of the list if a
+             file can no longer be parsed
+    """
+    diff_method = DIFF_METHODS[args.diff_method]
+    load = functools.lru_cache(maxsize=32)(lambda filename: load_source(
+        filename, read_file(filename), cache_dir=args.cache_dir, profile=args.profile,
+        with_tree=DIFF_METHODS[args.diff_method].with_tree))
+    for ref, candidate in pairs:
+        valid, raw_result = compare_parsed(load(ref), load(candidate), diff_method, symmetric=args.symmetric,
+                                           match=args.match)
+        if not valid:
+            yield ref, candidate, None
+            continue
+        if args.symmetric:
+            raw_result = raw_result[0]
+        yield ref, candidate, reported_functions(raw_result, args.l, args.p)
+
+def _describe_func(filename, func_info):
+    return '{}:{} {}'.format(filename, func_info.lineno, func_info.func_name)
+
+def _report_lines(func_info):
+    return [line if line.endswith('\n') else line + '\n' for line in func_info.func_code_lines]
+
+def write_text_report(details, file):
+    """
+    One section per pair, with a unified diff of the code of every matched function.
+    """
+    for ref, candidate, func_diff_infos in details:
+        file.write('=' * 80 + '\n{} & {}\n'.format(ref, candidate))
+        if func_diff_infos is None:
+            file.write('Could not parse the files again\n')
+            continue
+        for func_diff_info in func_diff_infos:
+            file.write('\n{}\n'.format(func_diff_info))
+            ref_lines = _report_lines(func_diff_info.info_ref)
+            candidate_lines = _report_lines(func_diff_info.info_candidate)
+            diff = list(difflib.unified_diff(ref_lines, candidate_lines,
+                                             _describe_func(ref, func_diff_info.info_ref),
+                                             _describe_func(candidate, func_diff_info.info_candidate),
+                                             n=max(len(ref_lines), len(candidate_lines))))
+            # identical code has an empty diff, show the code itself
+            file.writelines(diff or [' ' + line for line in ref_lines])
+        file.write('\n')
+
+# the classes of difflib.HtmlDiff tables
+_REPORT_STYLE = '''
+table.diff {font-family: monospace; border: medium; margin-bottom: 1em;}
+.diff_header {background-color: #e0e0e0;}
+td.diff_header {text-align: right;}
+.diff_next {background-color: #c0c0c0;}
+.diff_add {background-color: #aaffaa;}
+.diff_chg {background-color: #ffff77;}
+.diff_sub {background-color: #ffaaaa;}
+'''
+
+def write_html_report(details, file):
+    """
+    One section per pair, with a side-by-side diff table of the code of every matched function.
+    """
+    import html
+    html_diff = difflib.HtmlDiff(wrapcolumn=80)
+    file.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>pycode_similar report</title>\n'
+               '<style>{}</style>\n</head>\n<body>\n'.format(_REPORT_STYLE))
+    for ref, candidate, func_diff_infos in details:
+        file.write('<h2>{} &amp; {}</h2>\n'.format(html.escape(ref), html.escape(candidate)))
+        if func_diff_infos is None:
+            file.write('<p>Could not parse the files again</p>\n')
+            continue
+        for func_diff_info in func_diff_infos:
+            file.write('<h3>{}</h3>\n'.format(html.escape(str(func_diff_info))))
+            file.write(html_diff.make_table(
+                [line.rstrip('\r\n') for line in func_diff_info.info_ref.func_code_lines],
+                [line.rstrip('\r\n') for line in func_diff_info.info_candidate.func_code_lines],
+                html.escape(_describe_func(ref, func_diff_info.info_ref)),
+                html.escape(_describe_func(candidate, func_diff_info.info_candidate))))
+            file.write('\n')
+    file.write('</body>\n</html>\n')
+
+REPORT_FORMATS = collections.OrderedDict([
+    ('text', write_text_report),
+    ('html', write_html_report),
+])
+
+def write_report(pairs, path, report_format='text'):
+    """
+    Write the code diffs of the matched functions of the detected pairs to path.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        REPORT_FORMATS[report_format](report_details(pairs), file)
+
+
+def new_loader():
+    """
+    A FileLoader parsing with the options of the run.
+    """
+    return FileLoader(io_concurrency=args.io_concurrency, jobs=args.jobs, cache_dir=args.cache_dir,
+                      profile=args.profile, with_tree=DIFF_METHODS[args.diff_method].with_tree,
+                      backend=args.backend)
 
-def run_batch(filename_list):
+def new_results(filename_list):
     results = {
         "configuration": {
             "files": filename_list,
             "PLAG_lower_bound": args.c,
             "func_PLAG_lower_bound": args.p,
-            "func_AST_lower_bound": args.l
+            "func_AST_lower_bound": args.l,
+            "profile": NormalizationProfile.get(args.profile).profile_id,
+            "diff_method": args.diff_method
         },
         "detected": list(),
-        "syntax_errors": list()
+        "syntax_errors": list(),
+        "recovered": list(),
+        "exact_copies": list()
     }
+    if args.diff_method == 'adaptive':
+        results["configuration"]["adaptive"] = {
+            "tree_budget": AdaptiveDiff.TREE_BUDGET if AdaptiveDiff.with_tree else 0,
+            "unified_budget": AdaptiveDiff.UNIFIED_BUDGET
+        }
+    return results
 
-    combinations = list(itertools.combinations(filename_list, 2))
-    # Initial call to print 0% progress
-    comb_length = len(combinations)
-    printProgressBar(0, comb_length, prefix = 'Progress:', suffix = 'Complete', length = 50)
-    for i,files_tuple in enumerate(combinations):
-        #Create combinations of all the files
-        file1 = files_tuple[0]
-        file2 = files_tuple[1]
-        # all_results.append(compare_files(file1, file2))
-        valid, raw_result = compare_files(file1, file2)
-        if valid:
-            json_result = jsonify(file1, file2, raw_result)
-            if json_result["percent_plagiarized"] >= args.c:        
+def score_pair(file1, file2, parsed1, parsed2, functions=None, diff_method=None):
+    """
+    Compare one pair of parsed files with the options of the run.
+
+    :param functions: if a list, collects the reported functions as dicts
+    :param diff_method: the diff method to use instead of the one of --diff-method
+    :return: (valid, raw_result, json_result) where json_result is the
+             detected entry, or None if the pair is not valid or below -c
+    """
+    diff_method = diff_method or DIFF_METHODS[args.diff_method]
+    if parsed1.valid:
+        valid, raw_result = compare_parsed(parsed1, parsed2, diff_method,
+                                           symmetric=args.symmetric, match=args.match,
+                                           cutoff=args.c if args.early_exit else None,
+                                           complete=not args.no_details)
+    else:
+        valid, raw_result = parsed1[:2]
+    json_result = None
+    if valid:
+        candidate_result = None
+        if args.symmetric:
+            raw_result, candidate_result = raw_result
+        json_result = jsonify(file1, file2, raw_result, functions, candidate_result)
+        if args.no_details:
+            del json_result["diff_list"]
+            json_result["all_diffed"] = len(raw_result) == len(parsed1.result)
+            if not json_result["all_diffed"]:
+                # a pair stopped once it is certain to reach -c: the functions not diffed count as not plagiarized
+                json_result["total_count"] = sum(diff_method.total(func_info, None) for func_info in parsed1.result)
+                json_result["percent_plagiarized"] = json_result["plagiarism_count"] / json_result["total_count"]
+            if functions is not None:
+                del functions[:]
+        if json_result.get("percent_combined", json_result["percent_plagiarized"]) < args.c:
+            json_result = None
+    return valid, raw_result, json_result
+
+def score_pairs(pairs, filenames, parsed, collect_functions=False):
+    """
+    score_pair on a chunk of the pairs of a tile.
+
+    :param pairs: list of (i, j) indices of filenames and parsed, which are only read
+    :return: list of (valid, error, json_result, functions), error being the
+             raw_result of an invalid pair; the FuncDiffInfos are not returned
+             so that they are not pickled back from worker processes
+    """
+    scored = []
+    for i, j in pairs:
+        functions = [] if collect_functions else None
+        valid, raw_result, json_result = score_pair(filenames[i], filenames[j], parsed[i], parsed[j], functions)
+        scored.append((valid, None if valid else raw_result, json_result, functions))
+    return scored
+
+class PairScorer(object):
+    """
+    Scores the pairs of a tile in the calling thread or in a pool of jobs workers.
+
+    The pairs are split into contiguous chunks, a few per worker, and the
+    results are yielded chunk by chunk in pair order. Worker threads share
+    the parse results of the tile cache; a worker process gets the parse
+    results of the files of its chunk pickled with the chunk.
+    """
+
+    CHUNKS_PER_JOB = 4
+
+    def __init__(self, jobs=1, backend='process'):
+        self._jobs = jobs
+        self._backend = resolve_backend(backend)
+        self._pool = None
+
+    def score(self, tile, filename_list, cache, collect_functions=False):
+        """
+        :return: iterator of the score_pairs results of the pairs of the tile, in iter_tile_pairs order
+        """
+        pairs = list(iter_tile_pairs(tile))
+        if self._jobs <= 1 or len(pairs) < 2:
+            for pair in pairs:
+                yield score_pairs([pair], filename_list, cache, collect_functions)[0]
+            return
+        if self._pool is None:
+            self._pool = new_executor(self._jobs, self._backend)
+        size = max(1, -(-len(pairs) // (self._jobs * self.CHUNKS_PER_JOB)))
+        futures = []
+        for start in range(0, len(pairs), size):
+            chunk = pairs[start:start + size]
+            if self._backend == 'thread':
+                futures.append(self._pool.submit(score_pairs, chunk, filename_list, cache, collect_functions))
+            else:
+                indices = set(itertools.chain.from_iterable(chunk))
+                futures.append(self._pool.submit(score_pairs, chunk,
+                                                 dict((index, filename_list[index]) for index in indices),
+                                                 dict((index, cache[index]) for index in indices),
+                                                 collect_functions))
+        for future in futures:
+            for scored in future.result():
+                yield scored
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+def compare_tile(tile, filename_list, cache, results, recovered, progress, writer=None, scorer=None):
+    """
+    Compare the pairs of one tile and add them to results (or writer).
+
+    :param recovered: set of the files already listed in results["recovered"]
+    :param scorer: the PairScorer of the run, None to score in the calling thread
+    """
+    cache.load(tile)
+    scored = (scorer or PairScorer()).score(tile, filename_list, cache, writer is not None)
+    for (i, j), (valid, raw_result, json_result, functions) in zip(iter_tile_pairs(tile), scored):
+        file1 = filename_list[i]
+        file2 = filename_list[j]
+        parsed1 = cache[i]
+        parsed2 = cache[j]
+        if args.d: print("Processing {} & {}...".format(file1, file2) + ("Success!" if valid or raw_result == [] else "Syntax Error!"))
+        for filename, parsed in ((file1, parsed1), (file2, parsed2)):
+            if parsed.recovered and filename not in recovered:
+                recovered.add(filename)
+                results["recovered"].append(filename)
+        if json_result is not None:
+            if writer is not None:
+                writer.add_pair(json_result, functions)
+            else:
                 results["detected"].append(json_result)
-        else:
+        elif not valid and raw_result:  # an empty result means the referenced file has no functions
             if raw_result not in results["syntax_errors"]: results["syntax_errors"].append(raw_result)
-        #Drag progress bar
-        printProgressBar(i+1, comb_length, prefix = 'Progress:', suffix = 'Complete', length = 50)
+        progress.advance()
+
+def run_batch(filename_list, writer=None):
+    results = new_results(filename_list)
+
+    loader = new_loader()
+    if not args.no_dedup:
+        # Byte-identical files are reported once as a group and only their
+        # first file takes part in the pairwise comparison.
+        filename_list, results["exact_copies"] = group_exact_copies(filename_list, loader.digest(filename_list))
+
+    event_stream = open(args.progress_events, 'a') if args.progress_events else None
+    if args.cluster:
+        results["configuration"]["cluster_threshold"] = args.cluster_threshold
+        results["clusters"] = list()
+        cluster_batch(filename_list, loader, results, event_stream)
+        loader.close()
+        if event_stream is not None:
+            event_stream.close()
+        return results
+    if args.fragments:
+        results["configuration"]["fragment_length"] = args.fragment_length
+        results["fragments"] = list()
+        fragment_batch(filename_list, loader, results, event_stream)
+        loader.close()
+        if event_stream is not None:
+            event_stream.close()
+        return results
+
+    tiles = iter_pair_tiles(len(filename_list), args.tile_size)
+    pair_count = count_pairs(len(filename_list))
+    if args.shard is not None:
+        shard, shard_count = args.shard
+        tiles = [tile for index, tile in enumerate(tiles) if index % shard_count == shard]
+        pair_count = sum(count_tile_pairs(tile) for tile in tiles)
+        results["configuration"]["shard"] = "{}/{}".format(shard, shard_count)
+        results["configuration"]["tile_size"] = args.tile_size
+        results["configuration"]["options"] = dict((name, getattr(args, name)) for name in QUEUE_OPTIONS)
+        # The function rows go into the shard output for the writers of the merge.
+        writer = _PartWriter(results)
+
+    progress = ProgressReporter(pair_count, interval=args.progress_interval, event_stream=event_stream)
+    progress.start()
+    cache = TileCache(filename_list, loader)
+    scorer = PairScorer(args.jobs, args.backend)
+    recovered = set()
+    for tile in tiles:
+        compare_tile(tile, filename_list, cache, results, recovered, progress, writer, scorer)
+
+    scorer.close()
+    loader.close()
+    progress.finish()
+    if event_stream is not None:
+        event_stream.close()
+    return results
+
+class TileQueue(object):
+    """
+    Work queue of the pair tiles of one batch in a shared directory.
+
+    The first worker writes plan.json (the files, tile size and scoring
+    options); every worker then claims tiles with an exclusively created
+    leases/<tile>.lease, renews it while the tile is scored and writes
+    done/<tile>.json. A lease that has not been renewed for lease_seconds
+    belongs to a worker that died and is broken by the next worker, up to
+    max_attempts times per tile, after which the tile is marked
+    failed/<tile>.json. Every step is an atomic create, link or rename, so
+    the directory can be shared by local processes or over NFS (with roughly
+    synchronized clocks).
+    """
+
+    def __init__(self, directory, lease_seconds=300, max_attempts=3):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        import socket
+        self.worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+        for name in ('leases', 'done', 'failed'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def _path(self, kind, index):
+        return os.path.join(self.directory, kind, '{}.{}'.format(index, 'lease' if kind == 'leases' else 'json'))
+
+    def _write_temp(self, data):
+        import tempfile
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file)
+        return temp_path
+
+    def create_plan(self, plan):
+        """
+        :return: the plan of the queue, the given one unless another worker was first
+        """
+        temp_path = self._write_temp(plan)
+        try:
+            os.link(temp_path, os.path.join(self.directory, 'plan.json'))
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+        return self.plan()
+
+    def plan(self):
+        """
+        :return: the plan of the queue, None if it has not been created yet
+        """
+        try:
+            with open(os.path.join(self.directory, 'plan.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def finished(self, index):
+        return os.path.exists(self._path('done', index)) or os.path.exists(self._path('failed', index))
+
+    def claim(self, index):
+        """
+        :return: True if this worker now holds the lease of the tile
+        """
+        if self.finished(index):
+            return False
+        lease_path = self._path('leases', index)
+        attempt = 1
+        try:
+            modified = os.stat(lease_path).st_mtime
+        except FileNotFoundError:
+            pass
+        else:
+            if time.time() - modified < self.lease_seconds:
+                return False
+            # stale lease: only one worker wins the rename
+            stale_path = '{}.{}'.format(lease_path, self.worker)
+            try:
+                os.rename(lease_path, stale_path)
+            except FileNotFoundError:
+                return False
+            if time.time() - os.stat(stale_path).st_mtime < self.lease_seconds:
+                # another worker renewed or replaced it in the meantime, hand it back
+                try:
+                    os.link(stale_path, lease_path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return False
+            with open(stale_path) as file:
+                attempt = json.load(file)["attempt"] + 1
+            os.remove(stale_path)
+            if attempt > self.max_attempts:
+                os.replace(self._write_temp({"attempts": attempt - 1}), self._path('failed', index))
+                return False
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as file:
+            json.dump({"worker": self.worker, "attempt": attempt}, file)
+        return True
+
+    def renew(self, index):
+        try:
+            os.utime(self._path('leases', index))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, index, part):
+        os.replace(self._write_temp(part), self._path('done', index))
+        try:
+            os.remove(self._path('leases', index))
+        except FileNotFoundError:
+            pass
+
+    def parts(self):
+        """
+        :return: the results of the done tiles, in tile order
+        """
+        parts = []
+        for index in range(self.plan()["tiles"]):
+            try:
+                with open(self._path('done', index)) as file:
+                    parts.append(json.load(file))
+            except FileNotFoundError:
+                pass
+        return parts
+
+    def failed(self):
+        return [index for index in range(self.plan()["tiles"]) if os.path.exists(self._path('failed', index))]
+
+class _LeaseKeeper(object):
+    """
+    Progress of a claimed tile that renews its lease on the way.
+    """
+
+    def __init__(self, queue, index):
+        self._queue = queue
+        self._index = index
+        self._renewed = time.monotonic()
+
+    def advance(self, count=1):
+        now = time.monotonic()
+        if now - self._renewed >= self._queue.lease_seconds / 3:
+            self._queue.renew(self._index)
+            self._renewed = now
+
+class _PartWriter(object):
+    """
+    Keeps the function rows of every pair in a shard or queue part, for the writers of the merge.
+    """
+
+    def __init__(self, results):
+        self._results = results
+
+    def add_pair(self, pair, functions):
+        pair["functions"] = functions
+        self._results["detected"].append(pair)
+
+# The options every worker of a queue takes from its plan, and that the parts
+# of a merge must agree on.
+QUEUE_OPTIONS = ('c', 'l', 'p', 'tile_size', 'profile', 'diff_method', 'symmetric', 'match', 'early_exit',
+                 'no_details')
+
+def use_options(options):
+    """
+    Take over the QUEUE_OPTIONS values of a queue plan or of merged results.
+    """
+    for name, value in options.items():
+        setattr(args, name, value)
+    resolve_diff_method(args.diff_method)
+
+def run_queue(filename_list, directory):
+    """
+    Work on the tiles of the queue in directory until every tile is done or failed.
+
+    The first worker creates the queue from filename_list and its options,
+    the others join it (filename_list may then be empty).
+    """
+    queue = TileQueue(directory, args.lease_seconds, args.max_attempts)
+    loader = new_loader()
+    plan = queue.plan()
+    if plan is None:
+        if len(filename_list) < 2:
+            raise ValueError("The queue {} does not exist yet, its files must be supplied".format(directory))
+        configuration = new_results(filename_list)["configuration"]
+        configuration["tile_size"] = args.tile_size
+        configuration["options"] = dict((name, getattr(args, name)) for name in QUEUE_OPTIONS)
+        exact_copies = []
+        if not args.no_dedup:
+            filename_list, exact_copies = group_exact_copies(filename_list, loader.digest(filename_list))
+        plan = queue.create_plan({
+            "configuration": configuration,
+            "exact_copies": exact_copies,
+            "files": filename_list,
+            "options": configuration["options"],
+            "tiles": sum(1 for tile in iter_pair_tiles(len(filename_list), args.tile_size))
+        })
+    # parse with the options of the queue, not the ones this worker was started with
+    use_options(plan["options"])
+    loader.close()
+    loader = new_loader()
+    filename_list = plan["files"]
+    tiles = list(iter_pair_tiles(len(filename_list), args.tile_size))
+    cache = TileCache(filename_list, loader)
+    scorer = PairScorer(args.jobs, args.backend)
+    while True:
+        pending = False
+        for index, tile in enumerate(tiles):
+            if not queue.claim(index):
+                pending = pending or not queue.finished(index)
+                continue
+            results = new_results(plan["configuration"]["files"])
+            results["configuration"] = plan["configuration"]
+            results["exact_copies"] = plan["exact_copies"]
+            compare_tile(tile, filename_list, cache, results, set(), _LeaseKeeper(queue, index), _PartWriter(results),
+                         scorer)
+            queue.complete(index, results)
+            if args.d: print("{} finished tile {}".format(queue.worker, index))
+        if not pending:
+            break
+        time.sleep(min(queue.lease_seconds / 3, 5))  # wait for the other workers or their leases to expire
+    scorer.close()
+    loader.close()
+    return queue
+
+def pair_order(filename_list, tile_size):
+    """
+    Sort key of detected pairs in the order of a single run comparing filename_list.
+    """
+    index = dict((filename, position) for position, filename in enumerate(filename_list))
+
+    def _key(pair):
+        i, j = index[pair["ref"]], index[pair["candidate"]]
+        return i // tile_size, j // tile_size, i, j
+    return _key
 
+def _merge_settings(configuration):
+    """
+    The settings of the configuration of a part that every part of a merge shares, options flattened.
+    """
+    settings = dict((key, value) for key, value in configuration.items() if key not in ("shard", "options"))
+    settings.update(configuration.get("options", {}))
+    return settings
+
+def merge_results(parts, writer=None, failed_tiles=()):
+    """
+    Combine the results of shards or queue tiles of one batch into the results of a single run.
+
+    Detected pairs are put in the order of a single run, syntax errors and
+    recovered files in input order. All parts must have been produced from the
+    same files with the same options.
+    """
+    if not parts:
+        raise ValueError("Nothing to merge")
+    configuration = dict(parts[0]["configuration"])
+    configuration.pop("shard", None)
+    settings = _merge_settings(configuration)
+    for part in parts[1:]:
+        other = _merge_settings(part["configuration"])
+        differing = sorted(key for key in set(settings) | set(other) if settings.get(key) != other.get(key))
+        if differing:
+            raise ValueError("The results to merge were produced with different {}".format(', '.join(differing)))
+    shards = set(part["configuration"].get("shard") for part in parts)
+    shards.discard(None)
+    if shards:
+        shard_count = int(next(iter(shards)).split('/')[1])
+        missing = sorted(set(range(shard_count)) - set(int(shard.split('/')[0]) for shard in shards))
+        if missing:
+            raise ValueError("Missing shards: {}".format(', '.join(str(shard) for shard in missing)))
+    if writer is not None and any("functions" not in pair for part in parts for pair in part["detected"]):
+        raise ValueError("The results to merge have no function rows, merge them with --format json")
+    results = {
+        "configuration": configuration,
+        "detected": list(),
+        "syntax_errors": list(),
+        "recovered": list(),
+        "exact_copies": parts[0]["exact_copies"]
+    }
+    if failed_tiles:
+        results["failed_tiles"] = list(failed_tiles)
+
+    position = dict((filename, index) for index, filename in enumerate(configuration["files"]))
+    for key in ("syntax_errors", "recovered"):
+        results[key] = sorted(set(filename for part in parts for filename in part[key]), key=position.get)
+    copies = set(filename for group in results["exact_copies"] for filename in group[1:])
+    compared = [filename for filename in configuration["files"] if filename not in copies]
+    detected = sorted((pair for part in parts for pair in part["detected"]),
+                      key=pair_order(compared, configuration.get("tile_size", len(compared) or 1)))
+    for pair in detected:
+        functions = pair.pop("functions", [])
+        if writer is not None:
+            writer.add_pair(pair, functions)
+        else:
+            results["detected"].append(pair)
     return results
-    
+
+def expand_inputs(paths):
+    """
+    The input files, with every directory replaced by the python files below it.
+    """
+    filename_list = []
+    for path in paths:
+        if os.path.isdir(path):
+            filename_list.extend(sorted(glob.glob(os.path.join(path, '**', '*.py'), recursive=True)))
+        else:
+            filename_list.append(path)
+    return list(collections.OrderedDict.fromkeys(filename_list))
+
+def scan_inputs(paths):
+    """
+    :return: OrderedDict of the input files to their (mtime, size) signature
+    """
+    signatures = collections.OrderedDict()
+    for filename in expand_inputs(paths):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue  # removed since the directory was listed
+        signatures[filename] = (stat.st_mtime_ns, stat.st_size)
+    return signatures
+
+def _load_readable(loader, filenames):
+    """
+    loader.load and loader.digest of the files that can be read; the others
+    (removed since they were listed, not readable) are left out.
+
+    :return: dict of filename to (digest, ParseResult)
+    """
+    try:
+        digests = loader.digest(filenames)
+        loaded = loader.load(filenames)
+        return dict((filename, (digests[filename], loaded[filename])) for filename in filenames)
+    except OSError:
+        if len(filenames) == 1:
+            return {}
+    readable = {}
+    for filename in filenames:
+        readable.update(_load_readable(loader, [filename]))
+    return readable
+
+def run_watch(paths):
+    """
+    Poll the inputs and keep the results in -o up to date until interrupted.
+
+    Every file is parsed once and kept in memory with its detected pairs.
+    When files are added, changed or removed, only those are parsed again,
+    only the pairs with one of them are scored again, and the results are
+    rewritten (atomically, readers never see a partial file). Byte-identical
+    files are grouped as in a single run unless --no-dedup is given. A file
+    that cannot be read is left out until a later scan can read it.
+    """
+    import tempfile
+    loader = new_loader()
+    corpus = {}  # filename -> (signature, digest, ParseResult)
+    scored = set()  # (ref, candidate) pairs scored since their files last changed
+    detected = {}  # (ref, candidate) -> detected entry
+    try:
+        while True:
+            signatures = scan_inputs(paths)
+            changed = [filename for filename, signature in signatures.items()
+                       if filename not in corpus or corpus[filename][0] != signature]
+            removed = [filename for filename in corpus if filename not in signatures]
+            if changed or removed or not detected and not corpus:
+                started = time.monotonic()
+                for filename in removed:
+                    del corpus[filename]
+                loaded = _load_readable(loader, changed)
+                for filename in changed:
+                    if filename in loaded:
+                        corpus[filename] = (signatures[filename],) + loaded[filename]
+                    else:
+                        corpus.pop(filename, None)  # retried by the next scan
+                stale = set(changed) | set(removed)
+                scored = set(pair for pair in scored if pair[0] not in stale and pair[1] not in stale)
+                detected = dict((pair, entry) for pair, entry in detected.items() if pair in scored)
+
+                filename_list = [filename for filename in signatures if filename in corpus]
+                results = new_results(filename_list)
+                compared = filename_list
+                if not args.no_dedup:
+                    compared, results["exact_copies"] = group_exact_copies(
+                        filename_list, dict((filename, corpus[filename][1]) for filename in filename_list))
+                for i, file1 in enumerate(compared):
+                    for file2 in compared[i + 1:]:
+                        if (file1, file2) not in scored:
+                            scored.add((file1, file2))
+                            json_result = score_pair(file1, file2, corpus[file1][2], corpus[file2][2])[2]
+                            if json_result is not None:
+                                detected[(file1, file2)] = json_result
+
+                compared_set = set(compared)
+                results["detected"] = sorted((entry for pair, entry in detected.items()
+                                              if pair[0] in compared_set and pair[1] in compared_set),
+                                             key=pair_order(compared, args.tile_size))
+                results["syntax_errors"] = [filename for filename in compared if not corpus[filename][2].valid]
+                results["recovered"] = [filename for filename in compared if corpus[filename][2].recovered]
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(args.o)), suffix='.tmp')
+                with os.fdopen(fd, 'w') as outfile:
+                    json.dump(results, outfile, indent=4)
+                os.replace(temp_path, args.o)
+                print("{}: {} changed, {} removed, {} unreadable, {} detected, updated in {:.2f}s".format(
+                    datetime.datetime.now().strftime('%H:%M:%S'), len(changed), len(removed),
+                    len(changed) - len(loaded), len(results["detected"]), time.monotonic() - started))
+            time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loader.close()
+
+class CorpusStore(object):
+    """
+    SQLite store of a corpus of files in which every distinct normalized
+    function is stored once.
+
+    A function is stored under its struct_hash with its AST dump (zlib
+    compressed) and node count, and a file is the list of its functions as
+    references to their hash, with their name and position in that file.
+    Removing a file only removes its references; gc deletes the functions
+    that no file refers to any more and compacts the database. The AST dumps
+    differ between python versions and profiles, so a store only takes the
+    files of the version and profile it was created with.
+    """
+
+    VERSION = 1
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS functions (
+            hash TEXT PRIMARY KEY,
+            nsubnodes INTEGER NOT NULL,
+            ast BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            recovered INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS file_functions (
+            path TEXT NOT NULL REFERENCES files (path),
+            position INTEGER NOT NULL,
+            hash TEXT NOT NULL REFERENCES functions (hash),
+            name TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            col INTEGER NOT NULL,
+            endline INTEGER NOT NULL,
+            PRIMARY KEY (path, position)
+        );
+        CREATE INDEX IF NOT EXISTS file_functions_hash ON file_functions (hash);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path, profile='default'):
+        """
+        Open the store in path, creating it if needed.
+
+        :raise ValueError: if the store was created by another python version or with another profile
+        """
+        import sqlite3
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(self.SCHEMA)
+        meta = {
+            "version": str(self.VERSION),
+            "python": "{}.{}".format(*sys.version_info[:2]),
+            "profile": NormalizationProfile.get(profile).profile_id
+        }
+        stored = dict(self._connection.execute('SELECT key, value FROM meta'))
+        if not stored:
+            self._connection.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+            self._connection.commit()
+        elif stored != meta:
+            self._connection.close()
+            raise ValueError("The store {} was created with {}, not {}".format(
+                path, ', '.join('{} {}'.format(key, stored.get(key)) for key in sorted(meta)),
+                ', '.join('{} {}'.format(key, meta[key]) for key in sorted(meta))))
+
+    def digest(self, filename):
+        """
+        :return: the digest of the file stored as filename, None if there is none
+        """
+        row = self._connection.execute('SELECT digest FROM files WHERE path = ?', (filename,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, filename, digest, parsed):
+        """
+        Store the functions of a valid ParseResult as filename, replacing the file stored under that name.
+        """
+        import zlib
+        self._delete(filename)
+        connection = self._connection
+        connection.execute('INSERT INTO files VALUES (?, ?, ?)', (filename, digest, int(parsed.recovered)))
+        connection.executemany(
+            'INSERT OR IGNORE INTO functions VALUES (?, ?, ?)',
+            ((func_info.struct_hash, func_info.nsubnodes, zlib.compress(func_info.func_ast.encode('utf-8')))
+             for func_info in parsed.result))
+        connection.executemany(
+            'INSERT INTO file_functions VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((filename, position, func_info.struct_hash, func_info.func_name, func_info.lineno,
+              func_info.col_offset, func_info.endlineno) for position, func_info in enumerate(parsed.result)))
+
+    def _delete(self, filename):
+        self._connection.execute('DELETE FROM file_functions WHERE path = ?', (filename,))
+        return self._connection.execute('DELETE FROM files WHERE path = ?', (filename,)).rowcount
+
+    def remove(self, path):
+        """
+        Remove the file stored as path, or every file stored below the directory path.
+
+        :return: the number of files removed
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        below = [row[0] for row in self._connection.execute(
+            'SELECT path FROM files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))]
+        return sum(self._delete(filename) for filename in [path] + below)
+
+    def gc(self):
+        """
+        Delete the functions no file refers to and compact the database.
+
+        :return: the number of functions deleted
+        """
+        deleted = self._connection.execute(
+            'DELETE FROM functions WHERE hash NOT IN (SELECT hash FROM file_functions)').rowcount
+        self._connection.commit()
+        self._connection.execute('VACUUM')
+        return deleted
+
+    def stats(self):
+        """
+        :return: dict of the numbers of files, function references and distinct functions
+        """
+        count = lambda table: self._connection.execute('SELECT count(*) FROM {}'.format(table)).fetchone()[0]
+        return {"files": count('files'), "references": count('file_functions'), "functions": count('functions')}
+
+    def load(self):
+        """
+        Every stored file with its functions, the AST lines of a function being shared by all files that contain it.
+
+        :return: OrderedDict of the stored file names, sorted, to their ParseResult
+        """
+        import zlib
+        ast_lines = {}
+        for func_hash, nsubnodes, ast in self._connection.execute(
+                'SELECT hash, nsubnodes, ast FROM functions WHERE hash IN (SELECT hash FROM file_functions)'):
+            ast_lines[func_hash] = (nsubnodes, tuple(sys.intern(line) for line in
+                                                     zlib.decompress(ast).decode('utf-8').splitlines(True)))
+        func_infos = collections.OrderedDict()
+        recovered = {}
+        for filename, file_recovered in self._connection.execute('SELECT path, recovered FROM files ORDER BY path'):
+            func_infos[filename] = []
+            recovered[filename] = bool(file_recovered)
+        for filename, func_hash, name, line, col, endline in self._connection.execute(
+                'SELECT path, hash, name, line, col, endline FROM file_functions ORDER BY path, position'):
+            nsubnodes, lines = ast_lines[func_hash]
+            func_infos[filename].append(FuncInfo(name, line, col, endline, nsubnodes, lines, filename,
+                                                 struct_hash=func_hash))
+        return collections.OrderedDict((filename, ParseResult(True, functions, recovered[filename]))
+                                       for filename, functions in func_infos.items())
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+class MemoizedDiff(object):
+    """
+    A diff method remembering its results by the struct_hash of both functions.
+
+    Until forget is called, a function is diffed once against each distinct
+    function however many files contain either of them. Only for the diff
+    methods whose results only depend on the AST lines, not on the trees.
+    """
+
+    def __init__(self, diff_method):
+        self.diff_method = diff_method
+        self.with_tree = diff_method.with_tree
+        self._diffs = {}
+        self._diff_counts = {}
+        self._bounds = {}
+        self._diffed = 0
+
+    def diff(self, a, b):
+        key = (a.struct_hash, b.struct_hash)
+        value = self._diffs.get(key)
+        if value is None:
+            value = self._diffs[key] = self.diff_method.diff(a, b)
+            self._diffed += 1
+        return value
+
+    def diff_counts(self, a, b):
+        key = (a.struct_hash, b.struct_hash)
+        counts = self._diff_counts.get(key)
+        if counts is None:
+            counts = self._diff_counts[key] = self.diff_method.diff_counts(a, b)
+            self._diffed += 1
+        return counts
+
+    def lower_bounds(self, a, candidates):
+        missing = [b for b in candidates if (a.struct_hash, b.struct_hash) not in self._bounds]
+        for b, bound in zip(missing, self.diff_method.lower_bounds(a, missing) if missing else ()):
+            self._bounds[(a.struct_hash, b.struct_hash)] = bound
+        return [self._bounds[(a.struct_hash, b.struct_hash)] for b in candidates]
+
+    def total(self, a, b):
+        return self.diff_method.total(a, b)
+
+    def forget(self):
+        """
+        Drop the remembered results, which grow with the functions diffed times the distinct functions they met.
+        """
+        self._diffs.clear()
+        self._diff_counts.clear()
+        self._bounds.clear()
+
+    @property
+    def remembered(self):
+        """
+        The number of results remembered since the last forget.
+        """
+        return len(self._diffs) + len(self._diff_counts) + len(self._bounds)
+
+    @property
+    def diffed(self):
+        """
+        The number of function pairs diffed so far, distinct between two forgets.
+        """
+        return self._diffed
+
+def update_store(store, filename_list):
+    """
+    Parse the files and store the ones that are new or changed since they were stored.
+
+    :return: (number of files stored, list of the files that failed to parse)
+    """
+    loader = new_loader()
+    digests = loader.digest(filename_list)
+    changed = [filename for filename in filename_list if store.digest(filename) != digests[filename]]
+    loaded = loader.load(changed)
+    loader.close()
+    syntax_errors = []
+    for filename in changed:
+        if loaded[filename].valid:
+            store.add(filename, digests[filename], loaded[filename])
+        else:
+            syntax_errors.append(filename)
+    store.commit()
+    return len(changed) - len(syntax_errors), syntax_errors
+
+def run_store(filename_list, store, writer=None):
+    """
+    Compare every file against every file of the store.
+
+    The stored files are loaded with their functions deduplicated and the
+    diffs are memoized by function (MemoizedDiff), so every function of a
+    file is diffed once against each distinct stored function and the
+    result is fanned out to every stored file that contains it. The memo
+    only lives for one file, so it stays bounded by the functions of the
+    file times the distinct stored functions. A file is not compared with
+    the stored file of the same name.
+    """
+    results = new_results(filename_list)
+    results["configuration"]["store"] = store.path
+    stored = store.load()
+    diff_method = MemoizedDiff(DIFF_METHODS[args.diff_method])
+    loader = new_loader()
+    loaded = loader.load(filename_list)
+    loader.close()
+
+    event_stream = open(args.progress_events, 'a') if args.progress_events else None
+    progress = ProgressReporter(len(filename_list) * len(stored), interval=args.progress_interval,
+                                event_stream=event_stream)
+    progress.start()
+    for filename in filename_list:
+        parsed = loaded[filename]
+        if not parsed.valid:
+            results["syntax_errors"].append(filename)
+            progress.advance(len(stored))
+            continue
+        if parsed.recovered:
+            results["recovered"].append(filename)
+        for stored_filename, stored_parsed in stored.items():
+            if stored_filename != filename:
+                functions = [] if writer is not None else None
+                json_result = score_pair(filename, stored_filename, parsed, stored_parsed, functions, diff_method)[2]
+                if json_result is not None:
+                    if writer is not None:
+                        writer.add_pair(json_result, functions)
+                    else:
+                        results["detected"].append(json_result)
+            progress.advance()
+        diff_method.forget()
+    progress.finish()
+    if event_stream is not None:
+        event_stream.close()
+    if args.d: print("Diffed {} function pairs".format(diff_method.diffed))
+    return results
+
 
 if __name__ == "__main__":
     print("---------PYCODE SIMILAR---------")
     parser = ArgParser(description='Checks for similarity in code')
-    parser.add_argument('files', nargs='+', help='The input files')
+    parser.add_argument('files', nargs='*', help='The input files or directories (with --merge, the results files to merge)')
     parser.add_argument('-c', type=check_percentage_limit, default=0.5, help='The total plagiarism cutoff percent (default: 0.5)')
     parser.add_argument('-l', type=check_line_limit, default=4, help='if AST line of the function >= value then output detail (default: 4)')
     parser.add_argument('-p', type=check_percentage_limit, default=0.5, help='if plagiarism percentage of the function >= value then output detail (default: 0.5)')
     parser.add_argument('-o', type=str, default="./results.out", help='File where results will be output (default: ./results.out)')
     parser.add_argument('-d', action='store_true', help='Turn debug mode on')
+    parser.add_argument('--progress-interval', type=check_seconds, default=0.2, help='Minimum seconds between progress updates (default: 0.2)')
+    parser.add_argument('--progress-events', type=str, default=None, help='Append progress events as JSON lines to this file')
+    parser.add_argument('--io-concurrency', type=check_positive_int, default=16, help='Maximum number of files read concurrently (default: 16)')
+    parser.add_argument('-j', '--jobs', type=check_positive_int, default=1, help='Number of workers parsing files and scoring pairs (default: 1)')
+    parser.add_argument('--backend', choices=['auto', 'process', 'thread'], default='auto', help='Run the -j workers as processes or threads; auto uses threads on free-threaded python builds only (default: auto)')
+    parser.add_argument('--no-dedup', action='store_true', help='Compare byte-identical files instead of reporting them as exact copies')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory caching normalized parse results between runs')
+    parser.add_argument('--tile-size', type=check_positive_int, default=64, help='Number of files per side of a pair tile; bounds the files held in memory (default: 64)')
+    parser.add_argument('--cluster', action='store_true', help='Report clone families of functions across all files instead of file pairs')
+    parser.add_argument('--cluster-threshold', type=check_similarity, default=0.8, help='Minimum similarity of two functions in a clone family (default: 0.8)')
+    parser.add_argument('--fragments', action='store_true', help='Report runs of AST lines shared by functions of different files instead of file pairs')
+    parser.add_argument('--fragment-length', type=check_positive_int, default=12, help='Minimum number of AST lines of a shared fragment (default: 12)')
+    parser.add_argument('--symmetric', action='store_true', help='Score both files of a pair and apply -c to the higher of the two scores')
+    parser.add_argument('--match', choices=['best'] + sorted(MATCH_ASSIGNMENTS), default='best', help='How functions are matched: each to its best candidate, or one to one (default: best)')
+    parser.add_argument('--early-exit', action='store_true', help='Stop diffing a pair as soon as it cannot reach -c')
+    parser.add_argument('--no-details', action='store_true', help='Leave out the function details; with --early-exit, a pair certain to reach -c is also stopped and reports a lower bound of its score')
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='json', help='Format of the output file (default: json)')
+    parser.add_argument('--diff-method', choices=list(DIFF_METHODS), default='unified', help='How two functions are compared: a diff of their AST lines, the tree edit distance of their ASTs (needs zss), or an engine picked by the size of the functions (default: unified)')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='default', help='Normalization profile applied before comparing (default: default)')
+    parser.add_argument('--shard', type=check_shard, default=None, help='Only compare the pair tiles of shard I of N, given as I/N')
+    parser.add_argument('--queue', type=str, default=None, help='Take pair tiles from the work queue in this shared directory, creating it from the files if needed')
+    parser.add_argument('--lease-seconds', type=check_seconds, default=300, help='Seconds after which the tile of an unresponsive queue worker is retried (default: 300)')
+    parser.add_argument('--max-attempts', type=check_positive_int, default=3, help='Attempts per queue tile before it is given up (default: 3)')
+    parser.add_argument('--watch', action='store_true', help='Keep running and update -o whenever input files are added, changed or removed')
+    parser.add_argument('--watch-interval', type=check_seconds, default=2, help='Seconds between two scans of the inputs in --watch mode (default: 2)')
+    parser.add_argument('--merge', action='store_true', help='Merge the results files (or the done tiles of --queue) into -o')
+    parser.add_argument('--report', type=str, default=None, help='Also write the code diffs of the matched functions of the detected pairs to this file')
+    parser.add_argument('--report-format', choices=list(REPORT_FORMATS), default='text', help='Format of the --report file: unified diffs as text, or side-by-side diffs as html (default: text)')
+    parser.add_argument('--store', type=str, default=None, help='SQLite corpus store of past files, each distinct function stored once; the files are compared against the stored files')
+    parser.add_argument('--store-add', action='store_true', help='Add the files to --store (or update them) instead of comparing them')
+    parser.add_argument('--store-remove', action='store_true', help='Remove the files (or every file below the directories) from --store instead of comparing them')
+    parser.add_argument('--store-gc', action='store_true', help='Delete the functions of --store no stored file uses any more and compact it')
     args = parser.parse_args()
 
     #Ensure that 2 or more files are supplied
-    if len(args.files) < 2:
-        parser.error("Must supply 2 or more files")
+    if args.merge:
+        if not args.files and not args.queue:
+            parser.error("Must supply the results files to merge")
+    elif args.watch:
+        if not args.files:
+            parser.error("Must supply the files or directories to watch")
+    elif args.store:
+        if not args.store_remove:
+            args.files = expand_inputs(args.files)
+        if not args.files and not args.store_gc:
+            parser.error("Must supply the files to compare against the store, or to add or remove")
+    else:
+        args.files = expand_inputs(args.files)
+        if len(args.files) < 2 and not args.queue:
+            parser.error("Must supply 2 or more files")
+    if args.cluster and (args.shard or args.queue or args.merge):
+        parser.error("--cluster cannot be sharded")
+    if args.fragments and (args.cluster or args.shard or args.queue or args.merge):
+        parser.error("--fragments cannot be sharded or combined with --cluster")
+    if args.watch and (args.cluster or args.fragments or args.shard or args.queue or args.merge or args.format != 'json'):
+        parser.error("--watch only writes json pair results of a single run")
+    if args.shard and args.format != 'json':
+        parser.error("--shard writes json results for --merge, use --format on the merge")
+    if args.report and (args.cluster or args.fragments or args.watch or (args.queue and not args.merge)):
+        parser.error("--report only applies to the pair results of a run or a merge")
+    if args.report and args.no_details:
+        parser.error("--report cannot be combined with --no-details")
+    if (args.store_add or args.store_remove or args.store_gc) and not args.store:
+        parser.error("--store-add, --store-remove and --store-gc need --store")
+    if args.store_add and args.store_remove:
+        parser.error("--store-add and --store-remove cannot be combined")
+    if args.store and (args.cluster or args.fragments or args.shard or args.queue or args.merge or args.watch or
+                       args.report):
+        parser.error("--store cannot be combined with --cluster, --fragments, --shard, --queue, --merge, --watch or --report")
+    if args.store and args.diff_method == 'tree':
+        parser.error("--store does not keep the trees of --diff-method tree")
+    if args.early_exit and (args.symmetric or args.match != 'best'):
+        parser.error("--early-exit only applies to --match best without --symmetric")
+    try:
+        resolve_diff_method(args.diff_method)
+    except ImportError as error:
+        parser.error("--diff-method {} is not available: {}".format(args.diff_method, error))
+
+    if args.watch:
+        run_watch(args.files)
+        print("DONE!")
+        sys.exit(0)
+
+    #Maintain the store
+    if args.store:
+        try:
+            store = CorpusStore(args.store, args.profile)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.store and (args.store_add or args.store_remove or args.store_gc):
+        if args.store_add:
+            added, syntax_errors = update_store(store, args.files)
+            print("Stored {} new or changed files, {} unchanged".format(added, len(args.files) - added - len(syntax_errors)))
+            for filename in syntax_errors:
+                print("Syntax error, not stored: {}".format(filename))
+        if args.store_remove:
+            removed = sum(store.remove(path) for path in args.files)
+            store.commit()
+            print("Removed {} files".format(removed))
+        if args.store_gc:
+            print("Deleted {} unused functions".format(store.gc()))
+        print("Store: {files} files, {references} function references, {functions} distinct functions".format(
+            **store.stats()))
+        store.close()
+        print("DONE!")
+        sys.exit(0)
+
+    #Work on the queue, its results are combined with --merge
+    if args.queue and not args.merge:
+        try:
+            run_queue(args.files, args.queue)
+        except ValueError as e:
+            parser.error(str(e))
+        print("DONE!")
+        sys.exit(0)
+
+    if args.merge and args.queue:
+        if not os.path.isfile(os.path.join(args.queue, 'plan.json')):
+            parser.error("{} is not a work queue".format(args.queue))
+        queue = TileQueue(args.queue)
+        parts = queue.parts()
+        failed_tiles = queue.failed()
+        if len(parts) + len(failed_tiles) < queue.plan()["tiles"]:
+            parser.error("The queue {} still has unfinished tiles".format(args.queue))
+    elif args.merge:
+        parts = []
+        for filename in args.files:
+            with open(filename) as file:
+                parts.append(json.load(file))
+        failed_tiles = ()
+    if args.merge and args.report and any("options" not in part["configuration"] for part in parts):
+        parser.error("--report needs results to merge that record their options, rerun the shards")
 
     #Run the batch
-    results = run_batch(args.files)
+    writer_class = OUTPUT_FORMATS[args.format]
+    writer = writer_class(args.o) if writer_class is not None else None
+    if writer is not None and args.report:
+        writer = PairRecorder(writer)
+    if args.merge:
+        try:
+            results = merge_results(parts, writer, failed_tiles)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.store:
+        results = run_store(args.files, store, writer)
+        store.close()
+    else:
+        results = run_batch(args.files, writer)
     #Save the results to the outfile
-    save_json_file(results)
+    if writer is not None:
+        writer.close(results)
+        print("Output saved in: {}".format(args.o))
+    else:
+        save_json_file(results)
+    if args.report:
+        if args.merge:
+            # match the functions again with the options the parts were scored with
+            try:
+                use_options(results["configuration"]["options"])
+            except ImportError as error:
+                parser.error("--diff-method {} is not available: {}".format(args.diff_method, error))
+        pairs = writer.pairs if writer is not None else [(pair["ref"], pair["candidate"])
+                                                         for pair in results["detected"]]
+        write_report(pairs, args.report, args.report_format)
+        print("Report saved in: {}".format(args.report))
 
     print("DONE!")
@@ -0,0 +1,157 @@
+"""
+Benchmarks of pycode_similar_batch on a corpus of python files.
+
+Run from the repository root, by default on the standard library:
+
+    python3 src/tests/benchmark.py memory [--files 1000] [paths ...]
+    python3 src/tests/benchmark.py startup [--runs 20] [file1 file2]
+    python3 src/tests/benchmark.py backends [--files 50] [--jobs 4] [paths ...]
+"""
+import argparse
+import glob
+import itertools
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SRC_DIR)
+
+import pycode_similar_batch
+
+
+def corpus(paths, count):
+    """
+    count python files found under paths, cycling through them if there are fewer.
+    """
+    filenames = []
+    for path in paths or [os.path.dirname(os.__file__)]:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, '**', '*.py'), recursive=True)))
+        else:
+            filenames.append(path)
+    if not filenames:
+        raise SystemExit('No python files found')
+    return list(itertools.islice(itertools.cycle(filenames), count))
+
+
+def bench_memory(options):
+    """
+    Memory held by the parse results of the corpus, as the tile loop and --cluster hold them.
+    """
+    filenames = corpus(options.paths, options.files or 1000)
+    tracemalloc.start()
+    start = time.perf_counter()
+    parsed = []
+    for filename in filenames:
+        result = pycode_similar_batch.parse_source(filename, pycode_similar_batch.read_file(filename))
+        if result.valid:
+            for func_info in result.result:
+                func_info.struct_hash
+        parsed.append(result)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    functions = sum(len(result.result) for result in parsed if result.valid)
+    scale = 1000.0 / len(filenames)
+    print('files: {}, functions: {}, parse: {:.1f}s'.format(len(filenames), functions, elapsed))
+    print('held per 1k files: {:.1f} MB, peak per 1k files: {:.1f} MB'.format(
+        current * scale / 1e6, peak * scale / 1e6))
+    try:
+        import resource
+    except ImportError:  # not on windows
+        return
+    print('process max RSS: {:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
+
+
+def import_times():
+    """
+    (self, cumulative) microseconds of every module imported by pycode_similar_batch, from python -X importtime.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import pycode_similar_batch'],
+                             cwd=SRC_DIR, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def bench_startup(options):
+    """
+    Import time of the module and end-to-end latency of a run on two files, as started per submission.
+    """
+    files = corpus(options.paths or [os.path.join(SRC_DIR, '..', 'in', 'sample')], 2)
+    runs = [import_times() for _ in range(options.runs)]
+    total = statistics.median(times['pycode_similar_batch'][1] for times in runs)
+    print('import pycode_similar_batch: {:.1f} ms (median of {})'.format(total / 1e3, options.runs))
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1][1], reverse=True)[1:options.top + 1]
+    for name, (self_us, cumulative_us) in slowest:
+        print('  {:<32} {:7.1f} ms'.format(name, cumulative_us / 1e3))
+
+    output = os.path.join(tempfile.mkdtemp(), 'results.out')
+    commands = [
+        ('script', [sys.executable, os.path.join(SRC_DIR, 'pycode_similar_batch.py')]),
+        ('-m', [sys.executable, '-m', 'pycode_similar_batch']),
+    ]
+    for label, command in commands:
+        latencies = []
+        for _ in range(options.runs):
+            start = time.perf_counter()
+            subprocess.run(command + ['-o', output] + [os.path.abspath(filename) for filename in files],
+                           cwd=SRC_DIR, stdout=subprocess.DEVNULL, check=True)
+            latencies.append(time.perf_counter() - start)
+        print('2-file run ({}): median {:.1f} ms, min {:.1f} ms'.format(
+            label, statistics.median(latencies) * 1e3, min(latencies) * 1e3))
+    os.remove(output)
+    os.rmdir(os.path.dirname(output))
+
+def bench_backends(options):
+    """
+    Parsing and pair scoring of the corpus in one tile, serially and with -j process and thread workers.
+    """
+    filenames = corpus(options.paths, options.files or 50)
+    pycode_similar_batch.args = argparse.Namespace(c=0.5, l=4, p=0.5, d=False, symmetric=False, match='best',
+                                                   early_exit=False, no_details=False, diff_method='unified')
+    tile = (0, len(filenames), 0, len(filenames))
+    print('files: {}, pairs: {}, GIL enabled: {}'.format(
+        len(filenames), pycode_similar_batch.count_pairs(len(filenames)),
+        getattr(sys, '_is_gil_enabled', lambda: True)()))
+    for jobs, backend in ((1, 'serial'), (options.jobs, 'process'), (options.jobs, 'thread')):
+        loader = pycode_similar_batch.FileLoader(jobs=jobs, backend=backend)
+        start = time.perf_counter()
+        loaded = loader.load(filenames)
+        parse = time.perf_counter() - start
+        loader.close()
+        parsed = [loaded[filename] for filename in filenames]
+        scorer = pycode_similar_batch.PairScorer(jobs, backend)
+        start = time.perf_counter()
+        detected = sum(1 for scored in scorer.score(tile, filenames, parsed) if scored[2] is not None)
+        score = time.perf_counter() - start
+        scorer.close()
+        print('{:<8} jobs {}: parse {:.2f}s, score {:.2f}s ({:.0f} pairs/s), detected {}'.format(
+            backend, jobs, parse, score, pycode_similar_batch.count_pairs(len(filenames)) / score, detected))
+
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'backends': bench_backends,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of pycode_similar_batch')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('paths', nargs='*', help='Python files or directories (default: the standard library)')
+    parser.add_argument('--files', type=int, default=None, help='Number of files (default: 1000, backends: 50)')
+    parser.add_argument('--jobs', type=int, default=4, help='Workers of each backend (default: 4)')
+    parser.add_argument('--runs', type=int, default=20, help='Repetitions of the startup measurements (default: 20)')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports listed by startup (default: 10)')
+    options = parser.parse_intermixed_args()
+    BENCHMARKS[options.benchmark](options)
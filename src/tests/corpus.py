@@ -0,0 +1,153 @@
+"""
+Generated python files for the tests: variants of one module, from exact
+copies through renamed, reordered and extended ones to unrelated code.
+"""
+import collections
+import os
+import re
+import sys
+
+BASE_FUNCTIONS = [
+    '''
+def mean(values):
+    total = 0
+    for value in values:
+        total += value
+    return total / len(values)
+''',
+    '''
+def clamp(x, low, high):
+    if x < low:
+        return low
+    if x > high:
+        return high
+    return x
+''',
+    '''
+def histogram(words):
+    counts = {}
+    for word in words:
+        if word in counts:
+            counts[word] += 1
+        else:
+            counts[word] = 1
+    return counts
+''',
+    '''
+class Stack(object):
+    def __init__(self):
+        self.items = []
+
+    def push(self, item):
+        self.items.append(item)
+
+    def pop(self):
+        if not self.items:
+            raise IndexError("pop from an empty stack")
+        return self.items.pop()
+''',
+    '''
+def binary_search(items, target):
+    low, high = 0, len(items) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        if items[middle] == target:
+            return middle
+        if items[middle] < target:
+            low = middle + 1
+        else:
+            high = middle - 1
+    return -1
+''',
+]
+
+UNRELATED = '''
+import os
+
+def walk_sizes(root):
+    sizes = []
+    for directory, _, names in os.walk(root):
+        sizes.extend(os.path.getsize(os.path.join(directory, name)) for name in names)
+    return sorted(sizes, reverse=True)
+
+def parse_pairs(text):
+    return dict(line.split("=", 1) for line in text.splitlines() if "=" in line)
+'''
+
+# match statements, python 3.10+
+MATCHING = '''
+def evaluate(expression):
+    match expression:
+        case ["add", left, right]:
+            return left + right
+        case ["neg", operand]:
+            return -operand
+        case {"op": kind, **options}:
+            return kind, options
+        case [head, *rest]:
+            return head, rest
+        case value:
+            return value
+'''
+
+RENAMES = {
+    'mean': 'average', 'values': 'numbers', 'total': 'acc', 'value': 'n',
+    'clamp': 'bound', 'low': 'lo', 'high': 'hi',
+    'histogram': 'frequencies', 'words': 'tokens', 'counts': 'freq', 'word': 'token',
+    'Stack': 'Pile', 'items': 'elements', 'push': 'put', 'item': 'element',
+    'binary_search': 'find', 'target': 'wanted', 'middle': 'mid',
+    'evaluate': 'calculate', 'expression': 'expr', 'left': 'lhs', 'right': 'rhs', 'operand': 'arg', 'kind': 'name',
+    'options': 'extra', 'head': 'first', 'rest': 'others',
+}
+
+
+def rename(source, mapping):
+    return re.sub(r'\b\w+\b', lambda match: mapping.get(match.group(0), match.group(0)), source)
+
+
+def join(functions):
+    return ''.join(functions)
+
+
+def generated_corpus():
+    """
+    :return: OrderedDict of file name to source
+    """
+    functions = BASE_FUNCTIONS
+    corpus = collections.OrderedDict()
+    corpus['base.py'] = join(functions)
+    corpus['copy.py'] = join(functions)
+    corpus['renamed.py'] = rename(join(functions), RENAMES)
+    corpus['reordered.py'] = join(functions[::-1])
+    corpus['commented.py'] = join(functions).replace(
+        '    total = 0\n', '    """Arithmetic mean."""\n    # running sum\n    total = 0\n    print("values", values)\n')
+    corpus['swapped.py'] = join(functions).replace('x < low', 'low > x').replace('x > high', 'high < x')
+    corpus['extended.py'] = join(functions).replace(
+        '    return total / len(values)\n',
+        '    if not values:\n        return 0\n    return total / len(values)\n').replace(
+        '            counts[word] = 1\n',
+        '            counts[word] = 1\n    for word in list(counts):\n        if counts[word] < 2:\n'
+        '            del counts[word]\n')
+    corpus['partial.py'] = join(functions[:2]) + UNRELATED
+    corpus['unrelated.py'] = UNRELATED
+    corpus['broken.py'] = join(functions[:3]) + '\ndef broken(:\n    pass\n'
+    corpus['no_functions.py'] = 'VALUE = 1\nprint(VALUE)\n'
+    if sys.version_info >= (3, 10):
+        corpus['matching.py'] = MATCHING
+        corpus['matching_renamed.py'] = rename(MATCHING, RENAMES)
+    return corpus
+
+
+def write_corpus(directory):
+    """
+    Write generated_corpus to directory.
+
+    :return: the file paths in corpus order
+    """
+    paths = []
+    for name, source in generated_corpus().items():
+        path = os.path.join(directory, name)
+        with open(path, 'w') as file:
+            file.write(source)
+        paths.append(path)
+    return paths
@@ -0,0 +1,712 @@
+import os
+import sys
+sys.path.insert(0, os.path.realpath(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))))
+
+import collections
+import glob
+import importlib.util
+import io
+import itertools
+import json
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+import unittest
+from contextlib import closing
+
+import pycode_similar_batch
+from corpus import write_corpus
+
+SRC_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SCRIPT = os.path.join(SRC_DIR, 'pycode_similar_batch.py')
+SAMPLE_FILES = sorted(glob.glob(os.path.join(SRC_DIR, '..', 'in', 'sample', '*.py')))
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+# AST dumps, and so the scores, differ between python versions: one golden file per version.
+GOLDEN_PATH = os.path.join(GOLDEN_DIR, 'py{}{}.json'.format(*sys.version_info[:2]))
+UPDATE_GOLDEN = os.environ.get('PYCODE_SIMILAR_UPDATE_GOLDEN') == '1'
+ZSS_INSTALLED = importlib.util.find_spec('zss') is not None
+
+
+def run_cli(files, *options, **kwargs):
+    """
+    Run the script on files and return its JSON results.
+    """
+    output = kwargs.pop('output')
+    command = [sys.executable, SCRIPT] + list(options) + ['-o', output] + list(files)
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True, **kwargs)
+    with open(output) as file:
+        return json.load(file)
+
+
+def pair_scores(results):
+    """
+    The detected pairs as [ref, candidate, plagiarism_count, total_count] with file base names.
+    """
+    return [[os.path.basename(pair["ref"]), os.path.basename(pair["candidate"]), pair["plagiarism_count"],
+             pair["total_count"]] for pair in results["detected"]]
+
+
+def by_pair(results):
+    return sorted(results["detected"], key=lambda pair: (pair["ref"], pair["candidate"]))
+
+
+def brute_force_best_matches(func_info_ref, func_info_candidate, diff_method=pycode_similar_batch.UnifiedDiff):
+    """
+    The best match of every referenced function, diffing every candidate: (diff value, candidate index).
+    """
+    matches = []
+    for fi1 in func_info_ref:
+        values = [diff_method.diff(fi1, fi2) for fi2 in func_info_candidate]
+        best = min(range(len(values)), key=lambda index: (values[index], index)) if values else None
+        matches.append((values[best], best) if values else None)
+    return matches
+
+
+class CountingDiff(pycode_similar_batch.UnifiedDiff):
+    """
+    UnifiedDiff counting its diffs.
+    """
+
+    calls = 0
+
+    @staticmethod
+    def diff(a, b):
+        CountingDiff.calls += 1
+        return pycode_similar_batch.UnifiedDiff.diff(a, b)
+
+
+class BatchTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        corpus_directory = os.path.join(cls.directory, 'corpus')
+        os.mkdir(corpus_directory)
+        cls.generated = write_corpus(corpus_directory)
+        cls.corpus = cls.generated + SAMPLE_FILES
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    def parsed_corpus(self, **kwargs):
+        return [pycode_similar_batch.parse_source(filename, pycode_similar_batch.read_file(filename), **kwargs)
+                for filename in self.corpus]
+
+
+class TestGoldenScores(BatchTestCase):
+    """
+    The scores of the generated corpus and in/sample, pinned per python version.
+
+    Regenerate the golden file of the running python after an intended change
+    of the scores with PYCODE_SIMILAR_UPDATE_GOLDEN=1.
+    """
+
+    def current(self):
+        generated = run_cli(self.generated, '--no-dedup', '-c', '0', output=self.output('generated.json'))
+        strict = run_cli(self.generated, '--no-dedup', '-c', '0', '--profile', 'strict',
+                         output=self.output('generated_strict.json'))
+        optimal = run_cli(self.generated, '--no-dedup', '-c', '0', '--match', 'optimal',
+                          output=self.output('generated_optimal.json'))
+        sample = run_cli(SAMPLE_FILES, output=self.output('sample.json'))
+        clusters = run_cli(self.generated, '--cluster', output=self.output('clusters.json'))
+        fragments = run_cli(self.generated, '--fragments', output=self.output('fragments.json'))
+        return {
+            "generated": pair_scores(generated),
+            "generated_recovered": [os.path.basename(filename) for filename in generated["recovered"]],
+            "generated_strict": pair_scores(strict),
+            "generated_optimal": pair_scores(optimal),
+            "sample": pair_scores(sample),
+            "sample_syntax_errors": [os.path.basename(filename) for filename in sample["syntax_errors"]],
+            "sample_exact_copies": [[os.path.basename(filename) for filename in group]
+                                    for group in sample["exact_copies"]],
+            "clusters": [sorted('{}:{}'.format(os.path.basename(member["file"]), member["name"])
+                                for member in cluster["members"]) for cluster in clusters["clusters"]],
+            "fragments": [[fragment["length"], len(fragment["occurrences"])] for fragment in fragments["fragments"]],
+        }
+
+    def test_golden(self):
+        current = self.current()
+        if UPDATE_GOLDEN:
+            if not os.path.isdir(GOLDEN_DIR):
+                os.makedirs(GOLDEN_DIR)
+            with open(GOLDEN_PATH, 'w') as file:
+                json.dump(current, file, indent=1)
+        if not os.path.exists(GOLDEN_PATH):
+            self.skipTest('no golden scores for python {}.{}'.format(*sys.version_info[:2]))
+        with open(GOLDEN_PATH) as file:
+            golden = json.load(file)
+        for key in sorted(golden):
+            self.assertEqual(current[key], golden[key], key)
+
+    def test_invariants(self):
+        scores = dict(((ref, candidate), count / total)
+                      for ref, candidate, count, total in self.current()["generated"])
+        for variant in ('copy.py', 'reordered.py', 'commented.py'):
+            self.assertEqual(scores[('base.py', variant)], 1)
+        self.assertGreater(scores[('base.py', 'renamed.py')], 0.9)
+        self.assertGreater(scores[('base.py', 'swapped.py')], 0.9)
+        self.assertEqual(scores[('base.py', 'no_functions.py')], 0)
+        self.assertLess(scores[('base.py', 'unrelated.py')], scores[('base.py', 'partial.py')])
+
+
+class TestAcceleratedPaths(BatchTestCase):
+    """
+    Every faster way of getting the results gives the results of the plain single run.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAcceleratedPaths, cls).setUpClass()
+        cls.reference = run_cli(cls.corpus, '--no-dedup', '-c', '0', '--tile-size', '1000',
+                                output=os.path.join(cls.directory, 'reference.json'))
+
+    def assertSameResults(self, results, reference=None, ordered=False):
+        reference = reference or self.reference
+        if ordered:
+            self.assertEqual(results["detected"], reference["detected"])
+        else:
+            self.assertEqual(by_pair(results), by_pair(reference))
+        self.assertEqual(results["syntax_errors"], reference["syntax_errors"])
+        self.assertEqual(sorted(results["recovered"]), sorted(reference["recovered"]))
+
+    def run_variant(self, name, *options):
+        return run_cli(self.corpus, '--no-dedup', '-c', '0', *options, output=self.output(name))
+
+    def test_tiles(self):
+        self.assertSameResults(self.run_variant('tiles.json', '--tile-size', '3'))
+
+    def test_parse_cache(self):
+        cache_dir = self.output('cache')
+        self.assertSameResults(self.run_variant('cold.json', '--cache-dir', cache_dir), ordered=True)
+        self.assertTrue(os.listdir(cache_dir))
+        self.assertSameResults(self.run_variant('warm.json', '--cache-dir', cache_dir), ordered=True)
+
+    def test_parse_cache_source(self):
+        cache_dir = self.output('source_cache')
+        old, new = self.output('old.py'), self.output('new.py')
+        shutil.copy(self.generated[0], old)
+        shutil.copy(self.generated[0], new)
+        pycode_similar_batch.load_source(old, pycode_similar_batch.read_file(old), cache_dir)
+        os.remove(old)
+        parsed = pycode_similar_batch.load_source(new, pycode_similar_batch.read_file(new), cache_dir)
+        self.assertTrue(parsed.result[0].func_code.startswith('def mean(values):'))
+
+    def test_process_backend(self):
+        self.assertSameResults(self.run_variant('process.json', '-j', '2', '--backend', 'process'), ordered=True)
+
+    def test_thread_backend(self):
+        self.assertSameResults(self.run_variant('thread.json', '-j', '2', '--backend', 'thread'), ordered=True)
+
+    def test_early_exit(self):
+        reference = run_cli(self.corpus, '--no-dedup', output=self.output('cutoff.json'))
+        early_exit = run_cli(self.corpus, '--no-dedup', '--early-exit', output=self.output('early_exit.json'))
+        self.assertSameResults(early_exit, reference, ordered=True)
+
+    def test_early_exit_without_details(self):
+        reference = run_cli(self.corpus, '--no-dedup', '--no-details', output=self.output('no_details.json'))
+        early_exit = run_cli(self.corpus, '--no-dedup', '--early-exit', '--no-details',
+                             output=self.output('early_exit_no_details.json'))
+        self.assertEqual([(pair["ref"], pair["candidate"]) for pair in early_exit["detected"]],
+                         [(pair["ref"], pair["candidate"]) for pair in reference["detected"]])
+        self.assertTrue(all(pair["all_diffed"] for pair in reference["detected"]))
+        self.assertFalse(all(pair["all_diffed"] for pair in early_exit["detected"]))
+        for pair, expected in zip(early_exit["detected"], reference["detected"]):
+            self.assertEqual(pair["total_count"], expected["total_count"])
+            if pair["all_diffed"]:
+                self.assertEqual(pair, expected)
+            else:
+                self.assertLessEqual(pair["percent_plagiarized"], expected["percent_plagiarized"])
+                self.assertGreaterEqual(pair["percent_plagiarized"], 0.5)
+
+    def test_symmetric(self):
+        symmetric = self.run_variant('symmetric.json', '--symmetric')
+        for pair in symmetric["detected"]:
+            self.assertEqual(pair.pop("percent_ref"), pair["percent_plagiarized"])
+            self.assertEqual(pair.pop("percent_combined"),
+                             max(pair["percent_plagiarized"], pair.pop("percent_candidate")))
+            del pair["candidate_diff_list"]
+        self.assertSameResults(symmetric, ordered=True)
+
+    def test_shards(self):
+        reference = self.run_variant('tiled.json', '--tile-size', '4')
+        parts = [self.run_variant('shard{}.json'.format(shard), '--tile-size', '4', '--shard', '{}/3'.format(shard))
+                 for shard in range(3)]
+        merged = run_cli([self.output('shard{}.json'.format(shard)) for shard in range(3)], '--merge',
+                         output=self.output('merged.json'))
+        self.assertTrue(all(part["detected"] for part in parts))
+        self.assertSameResults(merged, reference, ordered=True)
+
+    def test_shards_merge_functions(self):
+        reference = self.output('tiled.db')
+        subprocess.run([sys.executable, SCRIPT, '--no-dedup', '-c', '0', '--tile-size', '4', '--format', 'sqlite',
+                        '-o', reference] + self.corpus, stdout=subprocess.DEVNULL, check=True)
+        for shard in range(3):
+            self.run_variant('shard{}.json'.format(shard), '--tile-size', '4', '--shard', '{}/3'.format(shard))
+        merged = self.output('merged.db')
+        subprocess.run([sys.executable, SCRIPT, '--merge', '--format', 'sqlite', '-o', merged] +
+                       [self.output('shard{}.json'.format(shard)) for shard in range(3)],
+                       stdout=subprocess.DEVNULL, check=True)
+        rows = []
+        for path in (reference, merged):
+            with closing(sqlite3.connect(path)) as connection:
+                rows.append(connection.execute('SELECT * FROM functions ORDER BY 1, 2, 3').fetchall())
+        self.assertTrue(rows[0])
+        self.assertEqual(rows[1], rows[0])
+
+    def test_merge_different_configurations(self):
+        self.run_variant('shard0.json', '--tile-size', '4', '--shard', '0/2')
+        for name, option in (('func_PLAG_lower_bound', ('-p', '0.8')), ('symmetric', ('--symmetric',)),
+                             ('match', ('--match', 'greedy'))):
+            self.run_variant('shard1.json', '--tile-size', '4', '--shard', '1/2', *option)
+            merge = subprocess.run([sys.executable, SCRIPT, '--merge', '-o', self.output('merged.json'),
+                                    self.output('shard0.json'), self.output('shard1.json')],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            self.assertNotEqual(merge.returncode, 0)
+            self.assertIn(name.encode(), merge.stderr)
+
+    def test_queue(self):
+        queue = self.output('queue')
+        reference = self.run_variant('tiled.json', '--tile-size', '4')
+        subprocess.run([sys.executable, SCRIPT, '--no-dedup', '-c', '0', '--tile-size', '4', '--queue', queue] +
+                       self.corpus, stdout=subprocess.DEVNULL, check=True)
+        merged = run_cli([], '--queue', queue, '--merge', output=self.output('queue_merged.json'))
+        self.assertSameResults(merged, reference, ordered=True)
+
+    def test_queue_workers(self):
+        queue = self.output('queue_workers')
+        reference = self.run_variant('tiled2.json', '--tile-size', '2')
+        # leases of a worker that died: one long expired, one just taken
+        pycode_similar_batch.TileQueue(queue)
+        for index, modified in ((0, time.time() - 60), (1, time.time())):
+            lease = os.path.join(queue, 'leases', '{}.lease'.format(index))
+            with open(lease, 'w') as file:
+                json.dump({"worker": "dead", "attempt": 1}, file)
+            os.utime(lease, (modified, modified))
+        options = ['--lease-seconds', '1', '--queue', queue]
+        workers = [subprocess.Popen([sys.executable, SCRIPT, '--no-dedup', '-c', '0', '--tile-size', '2'] + options +
+                                    self.corpus, stdout=subprocess.DEVNULL)]
+        deadline = time.time() + 60
+        while not os.path.exists(os.path.join(queue, 'plan.json')) and time.time() < deadline:
+            time.sleep(0.01)
+        workers += [subprocess.Popen([sys.executable, SCRIPT] + options, stdout=subprocess.DEVNULL)
+                    for _ in range(2)]
+        self.assertEqual([worker.wait(timeout=120) for worker in workers], [0, 0, 0])
+        merged = run_cli([], '--queue', queue, '--merge', output=self.output('queue_workers_merged.json'))
+        self.assertSameResults(merged, reference, ordered=True)
+        self.assertNotIn("failed_tiles", merged)
+        self.assertFalse(os.listdir(os.path.join(queue, 'leases')))
+
+    def watch(self, name, *options):
+        directory = self.output(name)
+        os.mkdir(directory)
+        for filename in self.corpus:
+            shutil.copy(filename, directory)
+        output = self.output(name + '.json')
+        reference = run_cli(sorted(glob.glob(os.path.join(directory, '*.py'))), *options,
+                            output=self.output(name + '_reference.json'))
+        process = subprocess.Popen([sys.executable, SCRIPT, '--watch', '--watch-interval', '0.1', '-o', output] +
+                                   list(options) + [directory], stdout=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 60
+            while not os.path.exists(output) and time.time() < deadline:
+                time.sleep(0.1)
+            with open(output) as file:
+                results = json.load(file)
+            self.assertSameResults(results, reference, ordered=True)
+            self.assertEqual(results["exact_copies"], reference["exact_copies"])
+            return results
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_watch(self):
+        self.assertTrue(self.watch('watched')["exact_copies"])
+        self.assertFalse(self.watch('watched_no_dedup', '--no-dedup')["exact_copies"])
+
+    def test_watch_unreadable_file(self):
+        missing = self.output('missing.py')
+        loader = pycode_similar_batch.FileLoader(jobs=1)
+        loaded = pycode_similar_batch._load_readable(loader, self.generated[:5] + [missing] + self.generated[5:])
+        loader.close()
+        self.assertEqual(sorted(loaded), sorted(self.generated))
+
+    def test_digest_read_once(self):
+        reads = collections.Counter()
+        read_file = pycode_similar_batch.read_file
+
+        def counting_read_file(filename):
+            reads[filename] += 1
+            return read_file(filename)
+        pycode_similar_batch.read_file = counting_read_file
+        try:
+            for jobs, read_buffer, expected in ((1, None, 1), (2, None, 1), (1, 0, 3)):
+                reads.clear()
+                loader = pycode_similar_batch.FileLoader(jobs=jobs)
+                if read_buffer is not None:
+                    loader.READ_BUFFER = read_buffer
+                digests = loader.digest(self.corpus)
+                for _ in range(2):
+                    loaded = loader.load(self.corpus)
+                loader.close()
+                self.assertEqual(set(reads.values()), {expected})
+                self.assertEqual(len(set(digests.values())),
+                                 len(set(read_file(filename) for filename in self.corpus)))
+                self.assertEqual([loaded[filename].valid for filename in self.corpus],
+                                 [parsed.valid for parsed in self.parsed_corpus()])
+        finally:
+            pycode_similar_batch.read_file = read_file
+
+    def test_normalizer_matches_reference_collector(self):
+        normalized = self.parsed_corpus()
+        reference = self.parsed_corpus(reference=True)
+        for filename, parsed, expected in zip(self.corpus, normalized, reference):
+            self.assertEqual(parsed.valid, expected.valid, filename)
+            if parsed.valid:
+                self.assertEqual([func_info.func_ast_lines for func_info in parsed.result],
+                                 [func_info.func_ast_lines for func_info in expected.result], filename)
+
+    def test_candidate_bounds(self):
+        parsed = [result.result for result in self.parsed_corpus() if result.valid]
+        CountingDiff.calls = 0
+        for func_info_ref, func_info_candidate in itertools.permutations(parsed, 2):
+            matches = pycode_similar_batch.compare_func_infos(func_info_ref, func_info_candidate, CountingDiff)
+            expected = brute_force_best_matches(func_info_ref, func_info_candidate)
+            by_function = dict((id(match.info_ref), match) for match in matches)
+            for fi1, best in zip(func_info_ref, expected):
+                match = by_function[id(fi1)]
+                if best is None:
+                    self.assertIsNone(match.info_candidate)
+                else:
+                    self.assertIs(match.info_candidate, func_info_candidate[best[1]])
+                    self.assertEqual(match.plagiarism_count, len(fi1.func_ast_lines) - best[0])
+        every_pair = sum(len(a) * len(b) for a, b in itertools.permutations(parsed, 2))
+        self.assertLess(CountingDiff.calls, every_pair / 2)
+
+    def test_adaptive_engines(self):
+        adaptive = pycode_similar_batch.AdaptiveDiff
+        unified = pycode_similar_batch.UnifiedDiff
+        parsed = [result.result for result in self.parsed_corpus() if result.valid]
+        budget = adaptive.UNIFIED_BUDGET
+        adaptive.UNIFIED_BUDGET = 20 * 20  # sends the larger functions of the corpus to the fingerprints
+        try:
+            engines = set()
+            for func_info_ref, func_info_candidate in itertools.permutations(parsed, 2):
+                for fi1 in func_info_ref:
+                    for fi2 in func_info_candidate:
+                        engine = adaptive.engine(fi1, fi2)
+                        engines.add(engine)
+                        if engine == 'unified':
+                            self.assertEqual(adaptive.diff_counts(fi1, fi2), unified.diff_counts(fi1, fi2))
+                        else:
+                            self.assertEqual(adaptive.diff(fi1, fi2), unified.lower_bounds(fi1, [fi2])[0])
+                matches = pycode_similar_batch.compare_func_infos(func_info_ref, func_info_candidate, adaptive)
+                expected = brute_force_best_matches(func_info_ref, func_info_candidate, adaptive)
+                self.assertEqual(sorted(len(match.info_ref.func_ast_lines) - match.plagiarism_count
+                                        for match in matches if match.info_candidate is not None),
+                                 sorted(best[0] for best in expected if best is not None))
+            self.assertEqual(engines, set(['unified', 'fingerprint']))  # no trees were parsed
+        finally:
+            adaptive.UNIFIED_BUDGET = budget
+
+    @unittest.skipIf(ZSS_INSTALLED, 'zss is installed')
+    def test_adaptive_without_zss(self):
+        results = self.run_variant('adaptive.json', '--diff-method', 'adaptive', '-j', '2', '--tile-size', '3')
+        self.assertEqual(results["configuration"]["adaptive"]["tree_budget"], 0)
+        for pair in results["detected"]:
+            self.assertLessEqual(set(pair.pop("engines")), set(['unified']))  # empty if nothing matched
+        self.assertSameResults(results)
+
+    def test_cluster_functions(self):
+        func_infos = [func_info for result in self.parsed_corpus() if result.valid for func_info in result.result
+                      if len(func_info.func_ast_lines) >= 4]
+        for threshold in (0.5, 0.8):
+            union_find = pycode_similar_batch.UnionFind(len(func_infos))
+            for i, j in itertools.combinations(range(len(func_infos)), 2):
+                small, large = sorted((func_infos[i], func_infos[j]), key=lambda info: len(info.func_ast_lines))
+                size_small, size_large = len(small.func_ast_lines), len(large.func_ast_lines)
+                if small.struct_hash == large.struct_hash or \
+                        size_small - pycode_similar_batch.UnifiedDiff.diff(small, large) >= threshold * size_large:
+                    union_find.union(i, j)
+            expected = [family for family in union_find.groups() if len(family) > 1]
+            self.assertEqual(pycode_similar_batch.cluster_functions(func_infos, threshold), expected)
+
+    def test_suffix_array(self):
+        generator = random.Random(0)
+        for _ in range(200):
+            tokens = [generator.randint(0, 3) for _ in range(generator.randint(1, 50))]
+            order = pycode_similar_batch.suffix_array(tokens)
+            self.assertEqual(order, sorted(range(len(tokens)), key=lambda start: tokens[start:]))
+            lcp = pycode_similar_batch.lcp_array(tokens, order)
+            for position in range(1, len(tokens)):
+                a, b = tokens[order[position - 1]:], tokens[order[position]:]
+                common = next((k for k, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+                self.assertEqual(lcp[position], common)
+
+    def test_shared_fragments(self):
+        parsed = [(filename, result.result) for filename, result in zip(self.corpus, self.parsed_corpus())
+                  if result.valid]
+        owners = [filename for filename, func_infos in parsed for _ in func_infos]
+        func_infos = [func_info for _, infos in parsed for func_info in infos]
+        lines = [[line.strip() for line in func_info.func_ast_lines] for func_info in func_infos]
+        min_length = 8
+        occurrences = collections.defaultdict(list)
+        for index, function_lines in enumerate(lines):
+            for start in range(len(function_lines)):
+                for stop in range(start + min_length, len(function_lines) + 1):
+                    occurrences[tuple(function_lines[start:stop])].append((index, start))
+        expected = []
+        for run, places in occurrences.items():
+            before = set(lines[index][start - 1] if start else (index, start) for index, start in places)
+            after = set(lines[index][start + len(run)] if start + len(run) < len(lines[index]) else (index, start)
+                        for index, start in places)
+            if len(before) > 1 and len(after) > 1 and len(set(owners[index] for index, _ in places)) > 1:
+                expected.append((len(run), sorted(places)))
+        self.assertTrue(expected)
+        self.assertEqual(sorted(pycode_similar_batch.shared_fragments(func_infos, owners, min_length)),
+                         sorted(expected))
+
+    def test_optimal_assignment(self):
+        generator = random.Random(0)
+        for _ in range(100):
+            rows, columns = generator.randint(1, 5), generator.randint(1, 5)
+            weights = [[generator.randint(0, 9) for _ in range(columns)] for _ in range(rows)]
+
+            def total(assignment):
+                return sum(weights[row][column] for row, column in assignment)
+            best = max(sum(weights[row][column] for row, column in zip(rows_order, columns_order))
+                       for rows_order in itertools.permutations(range(rows), min(rows, columns))
+                       for columns_order in itertools.permutations(range(columns), min(rows, columns)))
+            self.assertEqual(total(pycode_similar_batch.optimal_assignment(weights)), best)
+            self.assertLessEqual(total(pycode_similar_batch.greedy_assignment(weights)), best)
+
+    @unittest.skipUnless(ZSS_INSTALLED, 'zss is not installed')
+    def test_tree_engine(self):
+        reference = run_cli(self.corpus, '--no-dedup', '--diff-method', 'tree', '--tile-size', '1000',
+                            output=self.output('tree.json'))
+        parallel = run_cli(self.corpus, '--no-dedup', '--diff-method', 'tree', '-j', '2', '--tile-size', '3',
+                           output=self.output('tree_parallel.json'))
+        self.assertSameResults(parallel, reference)
+
+
+class TestMatch(BatchTestCase):
+    """
+    --match pairs every function with at most one function of the other file.
+    """
+
+    def test_match(self):
+        reference = run_cli(self.generated, '--no-dedup', '-c', '0', output=self.output('best.json'))
+        best = dict(((pair["ref"], pair["candidate"]), pair) for pair in reference["detected"])
+        counts = {}
+        for match in ('greedy', 'optimal'):
+            report = self.output('{}.txt'.format(match))
+            results = run_cli(self.generated, '--no-dedup', '--match', match, '-c', '0', '-p', '0', '-l', '0',
+                              '--report', report, output=self.output('{}.json'.format(match)))
+            self.assertEqual(set(best), set((pair["ref"], pair["candidate"]) for pair in results["detected"]))
+            for pair in results["detected"]:
+                candidates = [func_diff.split(', candidate ')[1] for func_diff in pair["diff_list"]]
+                self.assertEqual(len(candidates), len(set(candidates)))
+                self.assertLessEqual(pair["plagiarism_count"],
+                                     best[(pair["ref"], pair["candidate"])]["plagiarism_count"])
+                counts[match, pair["ref"], pair["candidate"]] = pair["plagiarism_count"]
+            with open(report) as file:
+                text = file.read()
+            self.assertEqual(text.count('=' * 80 + '\n'), len(results["detected"]))
+            for pair in results["detected"]:
+                for func_diff in pair["diff_list"]:
+                    self.assertIn('\n{}\n'.format(func_diff), text)
+            subprocess.run([sys.executable, SCRIPT, '--no-dedup', '--match', match, '-c', '0', '-p', '0', '-l', '0',
+                            '--format', 'csv', '-o', self.output('{}.csv'.format(match))] + self.generated,
+                           stdout=subprocess.DEVNULL, check=True)
+        for (match, ref, candidate), count in counts.items():
+            if match == 'greedy':
+                self.assertGreaterEqual(counts['optimal', ref, candidate], count)
+            if os.path.basename(candidate) == 'copy.py' and os.path.basename(ref) == 'base.py':
+                self.assertEqual(count, best[(ref, candidate)]["total_count"])
+
+
+class TestReport(BatchTestCase):
+    """
+    --report lists the functions of diff_list of every detected pair with their code.
+    """
+
+    def test_text_report(self):
+        report = self.output('report.txt')
+        results = run_cli(self.generated, '--report', report, output=self.output('report.json'))
+        with open(report) as file:
+            text = file.read()
+        sections = text.split('=' * 80 + '\n')[1:]
+        self.assertEqual(len(sections), len(results["detected"]))
+        for pair, section in zip(results["detected"], sections):
+            self.assertTrue(section.startswith('{} & {}\n'.format(pair["ref"], pair["candidate"])))
+            for func_diff in pair["diff_list"]:
+                self.assertIn('\n{}\n'.format(func_diff), section)
+        self.assertIn('-def clamp(x, low, high):\n', text)
+        self.assertIn('+def bound(x, lo, hi):\n', text)
+        self.assertIn(' def clamp(x, low, high):\n', text)  # the code of exact copies
+
+    def test_merged_report(self):
+        options = ['--profile', 'strict', '--symmetric', '-p', '0.8', '-c', '0', '--tile-size', '4']
+        for shard in range(2):
+            run_cli(self.generated, '--shard', '{}/2'.format(shard), *options,
+                    output=self.output('report_shard{}.json'.format(shard)))
+        report = self.output('merged_report.txt')
+        results = run_cli([self.output('report_shard{}.json'.format(shard)) for shard in range(2)], '--merge',
+                          '--report', report, output=self.output('merged_report.json'))
+        with open(report) as file:
+            text = file.read()
+        reported = [line for line in text.split('\n') if ': ref ' in line]
+        self.assertEqual(reported, [func_diff for pair in results["detected"] for func_diff in pair["diff_list"]])
+        self.assertTrue(reported)
+
+    def test_html_report_with_writer(self):
+        report = self.output('report.html')
+        subprocess.run([sys.executable, SCRIPT, '--format', 'csv', '--report', report, '--report-format', 'html',
+                        '-o', self.output('report.csv')] + self.generated, stdout=subprocess.DEVNULL, check=True)
+        reference = run_cli(self.generated, output=self.output('report_reference.json'))
+        with open(report) as file:
+            text = file.read()
+        self.assertEqual(text.count('<h2>'), len(reference["detected"]))
+        self.assertEqual(text.count('<table'), sum(len(pair["diff_list"]) for pair in reference["detected"]))
+        self.assertIn('binary_search', text)
+
+
+class TestProgress(BatchTestCase):
+    """
+    The progress is reported about once per interval, whatever the cost of the pairs.
+    """
+
+    def test_progress_events(self):
+        events = self.output('events.jsonl')
+        run_cli(self.corpus, '--no-dedup', '--progress-interval', '0', '--progress-events', events,
+                output=self.output('progress.json'))
+        with open(events) as file:
+            reported = [json.loads(line) for line in file]
+        pair_count = len(self.corpus) * (len(self.corpus) - 1) // 2
+        self.assertEqual(reported[0]["event"], 'start')
+        self.assertEqual(reported[-1]["event"], 'done')
+        self.assertEqual([event["done"] for event in reported[1:-1]], list(range(1, pair_count + 1)))
+        self.assertTrue(all(event["total"] == pair_count for event in reported))
+
+    def test_slower_pairs(self):
+        now = [0.0]
+        events = io.StringIO()
+        progress = pycode_similar_batch.ProgressReporter(101000, interval=0.2, event_stream=events,
+                                                         clock=lambda: now[0])
+        progress.start()
+        for cost in [0.00001] * 100000 + [0.05] * 1000:
+            now[0] += cost
+            progress.advance()
+        progress.finish()
+        reported = [json.loads(line) for line in events.getvalue().splitlines()]
+        self.assertEqual([event["event"] for event in reported[:1] + reported[-1:]], ['start', 'done'])
+        self.assertEqual(reported[-1]["done"], 101000)
+        for before, after in zip(reported, reported[1:]):
+            self.assertLessEqual(after["elapsed"] - before["elapsed"], 0.2 + 0.05 + 0.001)
+        self.assertGreaterEqual(len(reported), int(now[0] / 0.25))
+
+
+class TestSources(BatchTestCase):
+    """
+    Sources are decoded by their PEP 263 cookie or BOM, and bad bytes do not stop the run.
+    """
+
+    def test_decode_source(self):
+        decode_source = pycode_similar_batch.decode_source
+        self.assertEqual(decode_source('# -*- coding: latin-1 -*-\ns = "\xe9"\n'.encode('latin-1')),
+                         '# -*- coding: latin-1 -*-\ns = "\xe9"\n')
+        self.assertEqual(decode_source(b'\xef\xbb\xbfx = 1\n'), 'x = 1\n')
+        self.assertEqual(decode_source(b'x = "\xff"\n'), 'x = "\ufffd"\n')
+        self.assertEqual(decode_source(b'# coding: no-such-codec\nx = 1\n'), '# coding: no-such-codec\nx = 1\n')
+
+    def test_encodings(self):
+        code = 'def greet(name):\n    message = "h\xe9llo " + name\n    print(message)\n    return message\n'
+        files = []
+        for name, data in (('utf8.py', code.encode('utf-8')),
+                           ('latin1.py', ('# -*- coding: latin-1 -*-\n' + code).encode('latin-1')),
+                           ('bom.py', b'\xef\xbb\xbf' + code.encode('utf-8')),
+                           ('bad_bytes.py', code.encode('utf-8').replace('\xe9'.encode('utf-8'), b'\xff'))):
+            files.append(self.output(name))
+            with open(files[-1], 'wb') as file:
+                file.write(data)
+        results = run_cli(files, '--no-dedup', '-c', '0', '-l', '0', output=self.output('encodings.json'))
+        self.assertEqual(results["syntax_errors"], [])
+        self.assertEqual(len(results["detected"]), 6)
+        self.assertTrue(all(pair["percent_plagiarized"] == 1 for pair in results["detected"]))
+
+
+class TestCorpusStore(BatchTestCase):
+    """
+    Comparing against --store gives the pairs of a plain run, with every distinct function stored and diffed once.
+    """
+
+    def store_cli(self, store, *options):
+        subprocess.run([sys.executable, SCRIPT, '--store', store] + list(options), stdout=subprocess.DEVNULL,
+                       check=True)
+
+    def test_compare_against_store(self):
+        store = self.output('compare.db')
+        self.store_cli(store, '--store-add', *self.corpus)
+        ref = self.generated[0]
+        results = run_cli([ref], '--store', store, '-c', '0', output=self.output('store.json'))
+        reference = run_cli([ref] + sorted(filename for filename in self.corpus if filename != ref),
+                            '--no-dedup', '-c', '0', '--tile-size', '1000', output=self.output('store_reference.json'))
+        self.assertEqual(results["detected"], [pair for pair in reference["detected"] if pair["ref"] == ref])
+
+    def test_memoized_fan_out(self):
+        store = pycode_similar_batch.CorpusStore(self.output('memo.db'))
+        parsed = self.parsed_corpus()
+        for filename, result in zip(self.corpus, parsed):
+            if result.valid:
+                store.add(filename, 'digest', result)
+        stored = store.load()
+        store.close()
+        self.assertEqual(list(stored), sorted(stored))
+        memoized = pycode_similar_batch.MemoizedDiff(CountingDiff)
+        CountingDiff.calls = 0
+        distinct_count = 0
+        for result in parsed[:3] + parsed[:1]:
+            distinct = set()
+            for stored_parsed in stored.values():
+                matches = pycode_similar_batch.compare_func_infos(result.result, stored_parsed.result, memoized)
+                expected = pycode_similar_batch.compare_func_infos(result.result, stored_parsed.result)
+                self.assertEqual([(match.info_candidate, match.plagiarism_count) for match in matches],
+                                 [(match.info_candidate, match.plagiarism_count) for match in expected])
+                distinct.update((fi1.struct_hash, fi2.struct_hash) for fi1 in result.result
+                                for fi2 in stored_parsed.result)
+            # the memo of one file holds at most a diff and a bound per distinct function pair
+            self.assertLessEqual(memoized.remembered, 2 * len(distinct))
+            memoized.forget()
+            self.assertEqual(memoized.remembered, 0)
+            distinct_count += len(distinct)
+        self.assertEqual(CountingDiff.calls, memoized.diffed)
+        self.assertLessEqual(CountingDiff.calls, distinct_count)
+
+    def test_remove_and_gc(self):
+        store_path = self.output('gc.db')
+        distinct = set(func_info.struct_hash for result in self.parsed_corpus()[:len(self.generated)]
+                       for func_info in result.result)
+        self.store_cli(store_path, '--store-add', *self.generated)
+        store = pycode_similar_batch.CorpusStore(store_path)
+        stats = store.stats()
+        store.close()
+        self.assertEqual(stats["files"], len(self.generated))
+        self.assertEqual(stats["functions"], len(distinct))
+        self.assertLess(stats["functions"], stats["references"] / 2)
+
+        self.store_cli(store_path, '--store-remove', os.path.dirname(self.generated[0]))
+        store = pycode_similar_batch.CorpusStore(store_path)
+        self.assertEqual(store.stats(), {"files": 0, "references": 0, "functions": len(distinct)})
+        self.assertEqual(store.gc(), len(distinct))
+        self.assertEqual(store.stats()["functions"], 0)
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
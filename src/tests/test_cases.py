@@ -3,7 +3,7 @@ import sys
 sys.path.insert(0, os.path.realpath(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))))
 
 import unittest
-import pycode_similar
+import pycode_similar_batch as pycode_similar
 
 class TestCases(unittest.TestCase):
 
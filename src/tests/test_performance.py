@@ -0,0 +1,91 @@
+import os
+import sys
+sys.path.insert(0, os.path.realpath(os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))))
+
+import argparse
+import glob
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import pycode_similar_batch
+from corpus import generated_corpus
+
+SRC_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SCRIPT = os.path.join(SRC_DIR, 'pycode_similar_batch.py')
+SAMPLE_FILES = sorted(glob.glob(os.path.join(SRC_DIR, '..', 'in', 'sample', '*.py')))
+# Budgets are about ten times the timings measured on one core, to catch regressions in
+# complexity rather than noise. PYCODE_SIMILAR_TIME_SCALE stretches them on slow machines.
+TIME_SCALE = float(os.environ.get('PYCODE_SIMILAR_TIME_SCALE', '1'))
+COPIES = 20
+
+
+def best_time(function, repeat=3):
+    """
+    The fastest of repeat calls of function, in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+class TestPerformance(unittest.TestCase):
+    """
+    Timing budgets of fixed-size workloads: COPIES copies of the generated corpus.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sources = [('{}_{}'.format(copy, name), source.encode('utf-8'))
+                       for copy in range(COPIES) for name, source in generated_corpus().items()]
+        cls.parsed = [pycode_similar_batch.parse_source(filename, source) for filename, source in cls.sources]
+        cls.owners = []
+        cls.func_infos = []
+        for filename, parsed in zip([filename for filename, _ in cls.sources], cls.parsed):
+            if parsed.valid:
+                for func_info in parsed.result:
+                    cls.owners.append(filename)
+                    cls.func_infos.append(func_info)
+
+    def setUp(self):
+        pycode_similar_batch.args = argparse.Namespace(c=0.5, l=4, p=0.5, d=False, symmetric=False, match='best',
+                                                       early_exit=False, no_details=False, diff_method='unified')
+
+    def assertWithinBudget(self, function, budget):
+        elapsed = best_time(function)
+        self.assertLess(elapsed, budget * TIME_SCALE,
+                        '{:.3f}s over the budget of {:.3f}s'.format(elapsed, budget * TIME_SCALE))
+
+    def test_parse(self):
+        self.assertWithinBudget(
+            lambda: [pycode_similar_batch.parse_source(filename, source) for filename, source in self.sources], 3.0)
+
+    def test_compare(self):
+        base = self.parsed[0].result
+        renamed = self.parsed[2].result
+        self.assertWithinBudget(
+            lambda: [pycode_similar_batch.compare_func_infos(base, renamed) for _ in range(200)], 1.5)
+
+    def test_cluster(self):
+        self.assertWithinBudget(lambda: pycode_similar_batch.cluster_functions(self.func_infos, 0.8), 0.5)
+
+    def test_fragments(self):
+        self.assertWithinBudget(lambda: pycode_similar_batch.shared_fragments(self.func_infos, self.owners, 12), 1.5)
+
+    def test_two_file_run(self):
+        directory = tempfile.mkdtemp()
+        try:
+            output = os.path.join(directory, 'results.out')
+            command = [sys.executable, SCRIPT, '-o', output] + SAMPLE_FILES[:2]
+            self.assertWithinBudget(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True), 1.5)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()